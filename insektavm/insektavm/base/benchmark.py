@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from django.db import connection
+
+
+def run_concurrent(func, num_calls, concurrency):
+    # Calls func num_calls times from concurrency threads and returns throughput,
+    # error count and latency percentiles (in milliseconds)
+    def timed_call(i):
+        start = time.perf_counter()
+        try:
+            func()
+            error = None
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            # Every thread has its own database connection
+            connection.close()
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_call, range(num_calls)))
+    duration = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, error in results if error is None)
+    errors = {}
+    for latency, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    return {
+        'calls': num_calls,
+        'concurrency': concurrency,
+        'duration': duration,
+        'throughput': len(latencies) / duration if duration else 0,
+        'errors': errors,
+        'latency_ms': get_percentiles(latencies),
+    }
+
+
+def get_percentiles(latencies, percentiles=(50, 90, 99)):
+    if not latencies:
+        return {}
+    result = {}
+    for percentile in percentiles:
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        result['p{}'.format(percentile)] = latencies[index] * 1000
+    result['max'] = latencies[-1] * 1000
+    return result
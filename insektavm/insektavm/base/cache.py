@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class TTLCache:
+    # A small in-process cache. Every process has its own, so entries changed by
+    # another process are seen after ttl seconds at the latest.
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        # Calls load() on a miss. Exceptions raised by load() are not cached.
+        current_time = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > current_time:
+            return entry[0]
+        value = load()
+        if self.ttl > 0:
+            with self._lock:
+                if len(self._entries) >= self.max_size:
+                    # Entries are kept in insertion order, so this drops the oldest
+                    del self._entries[next(iter(self._entries))]
+                self._entries[key] = (value, current_time + self.ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,186 @@
+from xml.etree import ElementTree as ET
+
+# Builds the XML definitions passed to libvirt. This used to be done with Django
+# templates, but the template engine is too slow for something called for every
+# volume, domain, network and nwfilter while users wait for their VMs.
+
+OVMF_LOADER = '/usr/share/OVMF/OVMF_CODE.fd'
+
+
+def backing_volume_xml(name, capacity):
+    volume = ET.Element('volume')
+    _text(volume, 'name', name)
+    _text(volume, 'capacity', capacity)
+    target = ET.SubElement(volume, 'target')
+    ET.SubElement(target, 'format', type='qcow2')
+    return _to_string(volume)
+
+
+def volume_xml(name, capacity, backing_image):
+    volume = ET.Element('volume')
+    _text(volume, 'name', name)
+    _text(volume, 'capacity', capacity)
+    target = ET.SubElement(volume, 'target')
+    ET.SubElement(target, 'format', type='qcow2')
+    backing_store = ET.SubElement(volume, 'backingStore')
+    _text(backing_store, 'path', backing_image)
+    ET.SubElement(backing_store, 'format', type='qcow2')
+    return _to_string(volume)
+
+
+def raw_volume_xml(name, capacity):
+    volume = ET.Element('volume')
+    _text(volume, 'name', name)
+    _text(volume, 'capacity', capacity)
+    target = ET.SubElement(volume, 'target')
+    ET.SubElement(target, 'format', type='raw')
+    return _to_string(volume)
+
+
+def domain_xml(name, volume, memory, boot_type, network, mac, nwfilter_name, description='',
+               domain_type='kvm', uuid=None, vcpus=1, cpuset='', iothreads=0, disk_cache='',
+               disk_io='', net_queues=1, hugepages=False, memballoon='', graphics=True):
+    # Without a network the domain has no NIC, see interface_xml(). Empty values
+    # of the performance options leave the choice to libvirt.
+    domain = ET.Element('domain', type=domain_type)
+    _text(domain, 'name', name)
+    if uuid:
+        _text(domain, 'uuid', uuid)
+    _text(domain, 'description', description)
+    _text(domain, 'memory', memory, unit='M')
+    if hugepages:
+        memory_backing = ET.SubElement(domain, 'memoryBacking')
+        ET.SubElement(memory_backing, 'hugepages')
+    if cpuset:
+        _text(domain, 'vcpu', vcpus, placement='static', cpuset=cpuset)
+    else:
+        _text(domain, 'vcpu', vcpus)
+    if iothreads:
+        _text(domain, 'iothreads', iothreads)
+
+    os_element = ET.SubElement(domain, 'os')
+    if boot_type == 'efi':
+        _text(os_element, 'type', 'hvm', arch='x86_64', machine='pc-i440fx-2.8')
+        _text(os_element, 'loader', OVMF_LOADER, readonly='yes', type='pflash')
+        ET.SubElement(os_element, 'boot', dev='hd')
+    else:
+        _text(os_element, 'type', 'hvm', arch='x86_64')
+
+    features = ET.SubElement(domain, 'features')
+    ET.SubElement(features, 'acpi')
+    ET.SubElement(features, 'apic')
+    ET.SubElement(features, 'vmport', state='off')
+
+    cpu = ET.SubElement(domain, 'cpu', mode='host-model')
+    ET.SubElement(cpu, 'model', fallback='allow')
+
+    devices = ET.SubElement(domain, 'devices')
+    disk = ET.SubElement(devices, 'disk', type='file', device='disk')
+    driver = ET.SubElement(disk, 'driver', name='qemu', type='qcow2')
+    if disk_cache:
+        driver.set('cache', disk_cache)
+    if disk_io:
+        driver.set('io', disk_io)
+    if iothreads:
+        driver.set('iothread', '1')
+    ET.SubElement(disk, 'source', file=volume)
+    ET.SubElement(disk, 'target', dev='vda', bus='virtio')
+    if network:
+        devices.append(_interface(network, mac, nwfilter_name, net_queues))
+    if graphics:
+        ET.SubElement(devices, 'graphics', type='vnc', port='-1', autoport='yes', keymap='en-us')
+    if memballoon == 'none':
+        ET.SubElement(devices, 'memballoon', model='none')
+    elif memballoon == 'free_page_reporting':
+        # The guest returns free memory to the host
+        ET.SubElement(devices, 'memballoon', model='virtio', freePageReporting='on')
+    rng = ET.SubElement(devices, 'rng', model='virtio')
+    _text(rng, 'backend', '/dev/urandom', model='random')
+    return _to_string(domain)
+
+
+def interface_xml(network, mac, nwfilter_name, net_queues=1):
+    return _to_string(_interface(network, mac, nwfilter_name, net_queues))
+
+
+def _interface(network, mac, nwfilter_name, net_queues=1):
+    interface = ET.Element('interface', type='network')
+    ET.SubElement(interface, 'source', network=network)
+    ET.SubElement(interface, 'mac', address=mac)
+    ET.SubElement(interface, 'model', type='virtio')
+    if net_queues > 1:
+        ET.SubElement(interface, 'driver', name='vhost', queues=str(net_queues))
+    if nwfilter_name:
+        ET.SubElement(interface, 'filterref', filter=nwfilter_name)
+    return interface
+
+
+def network_xml(name, hosts, network_mask, network_gateway, dhcp_range_start, dhcp_range_end):
+    # hosts is an iterable of (mac, name, address) tuples
+    network = ET.Element('network')
+    _text(network, 'name', name)
+    ET.SubElement(network, 'forward', mode='route')
+    # Forbid outbound DNS forwarding of non-plain domains to prevent DNS tunneling
+    dns = ET.SubElement(network, 'dns', enable='yes', forwardPlainNames='no')
+    ET.SubElement(dns, 'forwarder', addr='0.0.0.0')
+    ip = ET.SubElement(network, 'ip', address=str(network_gateway), netmask=str(network_mask))
+    dhcp = ET.SubElement(ip, 'dhcp')
+    ET.SubElement(dhcp, 'range', start=str(dhcp_range_start), end=str(dhcp_range_end))
+    for host_mac, host_name, host_addr in hosts:
+        ET.SubElement(dhcp, 'host', mac=host_mac, name=host_name, ip=str(host_addr))
+    return _to_string(network)
+
+
+def nwfilter_xml(name, uuid, dhcp_server, network_ips, network_address, network_mask,
+                 access_nwfilter_name=None):
+    nwfilter = ET.Element('filter', name=name, chain='ipv4')
+    _text(nwfilter, 'uuid', uuid)
+    if dhcp_server:
+        filterref = ET.SubElement(nwfilter, 'filterref', filter='allow-dhcp-server')
+        _parameter(filterref, 'DHCPSERVER', dhcp_server)
+
+    clean_traffic = ET.SubElement(nwfilter, 'filterref', filter='clean-traffic')
+    for ip in network_ips:
+        _parameter(clean_traffic, 'IP', ip)
+    if not len(clean_traffic):
+        # DHCP Snooping / IP Learning is unreliable
+        _parameter(clean_traffic, 'CTRL_IP_LEARNING', 'dhcp')
+        if dhcp_server:
+            _parameter(clean_traffic, 'DHCPSERVER', dhcp_server)
+
+    if access_nwfilter_name:
+        ET.SubElement(nwfilter, 'filterref', filter=access_nwfilter_name)
+    rule = ET.SubElement(nwfilter, 'rule', action='accept', direction='in')
+    ET.SubElement(rule, 'ip', srcipaddr=str(network_address), srcipmask=str(network_mask))
+    rule = ET.SubElement(nwfilter, 'rule', action='accept', direction='out')
+    ET.SubElement(rule, 'ip', dstipaddr=str(network_address), dstipmask=str(network_mask))
+    # drop all other traffic
+    ET.SubElement(nwfilter, 'rule', action='drop', direction='inout')
+    return _to_string(nwfilter)
+
+
+def access_nwfilter_xml(name, uuid, ip_address):
+    # Without an IP address the filter is empty. The rules get a higher priority
+    # (lower value) than the default 500 of the drop rule in the including filter.
+    nwfilter = ET.Element('filter', name=name, chain='ipv4')
+    _text(nwfilter, 'uuid', uuid)
+    if ip_address:
+        rule = ET.SubElement(nwfilter, 'rule', action='accept', direction='in', priority='400')
+        ET.SubElement(rule, 'ip', srcipaddr=str(ip_address))
+        rule = ET.SubElement(nwfilter, 'rule', action='accept', direction='out', priority='400')
+        ET.SubElement(rule, 'ip', dstipaddr=str(ip_address))
+    return _to_string(nwfilter)
+
+
+def _text(parent, tag, text, **attrib):
+    element = ET.SubElement(parent, tag, attrib)
+    element.text = str(text)
+    return element
+
+
+def _parameter(parent, name, value):
+    return ET.SubElement(parent, 'parameter', name=name, value=str(value))
+
+
+def _to_string(element):
+    return ET.tostring(element, encoding='unicode')
@@ -0,0 +1,63 @@
+import ipaddress
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from insektavm.base import libvirtxml
+
+
+class Command(BaseCommand):
+    help = 'Measures how long building the libvirt XML definitions takes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=1000,
+                            help='Number of calls per measurement')
+
+    def handle(self, **options):
+        results = {}
+        results['volume'] = self._measure(options['number'], libvirtxml.volume_xml,
+                                          'vmimage_1.qcow2', 1 << 30,
+                                          '/var/lib/insekta/backing.qcow2')
+        results['domain'] = self._measure(options['number'], libvirtxml.domain_xml,
+                                          name='insekta_vm_1',
+                                          volume='/var/lib/insekta/vmimage_1.qcow2',
+                                          memory=512,
+                                          boot_type='efi',
+                                          network='insekta_vmnet_1',
+                                          mac='54:52:00:00:01:02',
+                                          nwfilter_name='vmnetnwfilter_1')
+        for prefix in (28, 24, 20):
+            network = ipaddress.IPv4Network('10.0.0.0/{}'.format(prefix))
+            hosts = list(network.hosts())
+            vm_hosts = [('54:52:00:00:01:{:0>2x}'.format(i & 0xff), 'vm{:0>2}'.format(i), host)
+                        for i, host in enumerate(hosts[1:-1])]
+            results['network /{}'.format(prefix)] = self._measure(
+                options['number'], libvirtxml.network_xml,
+                name='insekta_vmnet_1',
+                hosts=vm_hosts,
+                network_mask=network.netmask,
+                network_gateway=hosts[0],
+                dhcp_range_start=hosts[1],
+                dhcp_range_end=hosts[-1])
+            results['nwfilter /{}'.format(prefix)] = self._measure(
+                options['number'], libvirtxml.nwfilter_xml,
+                name='vmnetnwfilter_1',
+                uuid='01234567-89ab-cdef-0123-456789abcdef',
+                dhcp_server=hosts[0],
+                network_ips=hosts[1:],
+                network_address=network.network_address,
+                network_mask=network.netmask,
+                access_nwfilter_name='vmnetnwfilter_1_access')
+        results['access nwfilter'] = self._measure(options['number'],
+                                                   libvirtxml.access_nwfilter_xml,
+                                                   name='vmnetnwfilter_1_access',
+                                                   uuid='01234567-89ab-cdef-0123-456789abcdef',
+                                                   ip_address='172.16.0.5')
+        self.stdout.write(json.dumps(results, indent=4))
+
+    def _measure(self, number, func, *args, **kwargs):
+        duration = timeit.timeit(lambda: func(*args, **kwargs), number=number)
+        return {
+            'us_per_call': duration / number * 1e6
+        }
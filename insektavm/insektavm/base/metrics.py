@@ -0,0 +1,121 @@
+import bisect
+import threading
+
+from django.conf import settings
+
+from insektavm.base.cache import TTLCache
+
+# Metrics in the Prometheus text format. Counters and histograms live in the
+# process, gauges that need the database are computed by collectors when the
+# metrics are scraped and cached for a few seconds.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+_collectors = []
+_collector_cache = TTLCache(getattr(settings, 'METRICS_CACHE_TTL', 5))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _get_key(self, labels):
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get_samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, then the count and sum of all observations
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def get_samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', dict(labels, le=str(bucket)), cumulative))
+            samples.append((self.name + '_bucket', dict(labels, le='+Inf'), counts[-2]))
+            samples.append((self.name + '_count', labels, counts[-2]))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+        return samples
+
+
+def register_collector(collector):
+    # collector() returns a list of (name, help, samples) tuples for gauges, where
+    # samples is a list of (labels, value) tuples. It may run database queries.
+    _collectors.append(collector)
+    return collector
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        _render_metric(lines, metric.name, metric.type, metric.help, metric.get_samples())
+    for name, help, samples in _collector_cache.get('collectors', _collect):
+        _render_metric(lines, name, 'gauge', help,
+                       [(name, labels, value) for labels, value in samples])
+    return ''.join(lines)
+
+
+def _collect():
+    gauges = []
+    for collector in _collectors:
+        gauges.extend(collector())
+    return gauges
+
+
+def _render_metric(lines, name, type, help, samples):
+    lines.append('# HELP {} {}\n'.format(name, help))
+    lines.append('# TYPE {} {}\n'.format(name, type))
+    for sample_name, labels, value in samples:
+        if labels:
+            label_str = ','.join('{}="{}"'.format(label, _escape(label_value))
+                                 for label, label_value in labels.items())
+            lines.append('{}{{{}}} {}\n'.format(sample_name, label_str, value))
+        else:
+            lines.append('{} {}\n'.format(sample_name, value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1,4 +1,10 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete
+
+from insektavm.base.cache import TTLCache
+
+_user_token_cache = TTLCache(getattr(settings, 'LOOKUP_CACHE_TTL', 60))
 
 
 class UserToken(models.Model):
@@ -6,3 +12,15 @@ class UserToken(models.Model):
 
     def __str__(self):
         return self.username
+
+    @classmethod
+    def get_or_create_cached(cls, username):
+        return _user_token_cache.get(
+            username, lambda: cls.objects.get_or_create(username=username)[0])
+
+
+def _callback_user_token_deleted(sender, instance, **kwargs):
+    _user_token_cache.invalidate(instance.username)
+
+
+post_delete.connect(_callback_user_token_deleted, sender=UserToken)
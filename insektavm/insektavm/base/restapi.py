@@ -1,14 +1,20 @@
 import functools
 import json
+import time
 
 from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
+from insektavm.base import metrics
 from insektavm.base.utils import http_basic_auth
 from insektavm.base.virt import VirtError
 
 
+API_REQUEST_DURATION = metrics.Histogram('insekta_api_request_duration_seconds',
+                                         'Duration of REST API requests', ('view', 'status'))
+
+
 class ApiError(Exception):
     def __init__(self, message, resp_class=HttpResponse):
         self.message = message
@@ -21,17 +27,25 @@ def rest_api(func):
 
     @functools.wraps(func)
     def decorator(request, *args, **kwargs):
-        try:
-            ret = func(request, *args, **kwargs)
-            if isinstance(ret, HttpResponse):
-                return ret
-            elif isinstance(ret, dict):
-                return HttpResponse(json.dumps(ret), content_type='application/json')
-            else:
-                raise ValueError('Unexpected return type for API function')
-        except ApiError as e:
-            return e.resp_class(e.message, content_type='text/plain')
-        except VirtError as e:
-            return JsonResponse({'error': str(e)}, status=503)
-
-    return decorator
\ No newline at end of file
+        start_time = time.monotonic()
+        resp = _call_api(func, request, *args, **kwargs)
+        API_REQUEST_DURATION.observe(time.monotonic() - start_time,
+                                     view=func.__name__, status=resp.status_code)
+        return resp
+
+    return decorator
+
+
+def _call_api(func, request, *args, **kwargs):
+    try:
+        ret = func(request, *args, **kwargs)
+        if isinstance(ret, HttpResponse):
+            return ret
+        elif isinstance(ret, dict):
+            return HttpResponse(json.dumps(ret), content_type='application/json')
+        else:
+            raise ValueError('Unexpected return type for API function')
+    except ApiError as e:
+        return e.resp_class(e.message, content_type='text/plain')
+    except VirtError as e:
+        return JsonResponse({'error': str(e)}, status=503)
\ No newline at end of file
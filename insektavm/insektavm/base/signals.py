@@ -0,0 +1,4 @@
+from django.core.signals import Signal
+
+# Sent with node and connection arguments when a libvirt connection is dropped
+connection_invalidated = Signal()
@@ -1,3 +1,344 @@
-from django.test import TestCase
+import ipaddress
+import threading
+from unittest import mock
+from xml.etree import ElementTree as ET
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from insektavm.base import libvirtxml, metrics, virt
+
+
+# Based on the output of the Django templates that were used before libvirtxml
+GOLDEN_BACKING_VOLUME = """
+<volume>
+    <name>backing-foo-abc.qcow2</name>
+    <capacity>1234</capacity>
+    <target>
+        <format type='qcow2'/>
+    </target>
+</volume>
+"""
+
+GOLDEN_VOLUME = """
+<volume>
+    <name>vmimage_7.qcow2</name>
+    <capacity>1234</capacity>
+    <target>
+        <format type='qcow2'/>
+    </target>
+    <backingStore>
+        <path>/var/lib/insekta/backing-foo-abc.qcow2</path>
+        <format type='qcow2'/>
+    </backingStore>
+</volume>
+"""
+
+GOLDEN_DOMAIN = """
+<domain type="kvm">
+    <name>insekta_vm_7</name>
+    <description></description>
+    <memory unit="M">256</memory>
+    <vcpu>1</vcpu>
+    <os>
+        {os}
+    </os>
+    <features>
+        <acpi/>
+        <apic/>
+        <vmport state='off'/>
+    </features>
+    <cpu mode='host-model'>
+        <model fallback='allow'/>
+    </cpu>
+    <devices>
+        <disk type="file" device="disk">
+            <driver name="qemu" type="qcow2"/>
+            <source file="/var/lib/insekta/vmimage_7.qcow2"/>
+            <target dev="vda" bus="virtio"/>
+        </disk>
+        <interface type="network">
+            <source network="insekta_vmnet_3"/>
+            <mac address="54:52:00:00:03:02"/>
+            <model type="virtio"/>
+            <filterref filter="vmnetnwfilter_3"/>
+        </interface>
+        <graphics type="vnc" port="-1" autoport="yes" keymap="en-us"/>
+        <rng model="virtio">
+          <backend model="random">/dev/urandom</backend>
+        </rng>
+    </devices>
+</domain>
+"""
+
+GOLDEN_DOMAIN_OS_EFI = """
+        <type arch='x86_64' machine='pc-i440fx-2.8'>hvm</type>
+        <loader readonly='yes' type='pflash'>/usr/share/OVMF/OVMF_CODE.fd</loader>
+        <boot dev='hd'/>
+"""
+
+GOLDEN_DOMAIN_OS_MBR = """
+        <type arch='x86_64'>hvm</type>
+"""
+
+GOLDEN_NETWORK = """
+<network>
+    <name>insekta_vmnet_3</name>
+    <forward mode="route"/>
+    <!-- Forbid outbound DNS forwarding of non-plain domains to prevent DNS tunneling -->
+    <dns enable="yes" forwardPlainNames="no">
+        <forwarder addr="0.0.0.0"/>
+    </dns>
+    <ip address="10.0.0.1" netmask="255.255.255.248">
+        <dhcp>
+            <range start="10.0.0.2" end="10.0.0.6"/>
+                <host mac="54:52:00:00:03:00" name="vm00" ip="10.0.0.2"/>
+                <host mac="54:52:00:00:03:01" name="vm01" ip="10.0.0.3"/>
+        </dhcp>
+    </ip>
+</network>
+"""
+
+GOLDEN_NWFILTER = """
+<filter name="vmnetnwfilter_3" chain="ipv4">
+    <uuid>01234567-89ab-cdef-0123-456789abcdef</uuid>
+    <filterref filter="allow-dhcp-server">
+        <parameter name="DHCPSERVER" value="10.0.0.1"/>
+    </filterref>
+    <filterref filter="clean-traffic">
+        <parameter name="IP" value="10.0.0.2"/>
+        <parameter name="IP" value="10.0.0.3"/>
+    </filterref>
+    <filterref filter="vmnetnwfilter_3_access"/>
+    <rule action="accept" direction="in">
+        <ip srcipaddr="10.0.0.0" srcipmask="255.255.255.248"/>
+    </rule>
+    <rule action="accept" direction="out">
+        <ip dstipaddr="10.0.0.0" dstipmask="255.255.255.248"/>
+    </rule>
+    <!-- drop all other traffic -->
+    <rule action="drop" direction="inout"/>
+</filter>
+"""
+
+GOLDEN_NWFILTER_IP_LEARNING = """
+<filter name="vmnetnwfilter_3" chain="ipv4">
+    <uuid>01234567-89ab-cdef-0123-456789abcdef</uuid>
+    <filterref filter="allow-dhcp-server">
+        <parameter name="DHCPSERVER" value="10.0.0.1"/>
+    </filterref>
+    <filterref filter="clean-traffic">
+    <!-- DHCP Snooping / IP Learning is unreliable -->
+        <parameter name="CTRL_IP_LEARNING" value="dhcp"/>
+        <parameter name="DHCPSERVER" value="10.0.0.1"/>
+    </filterref>
+    <rule action="accept" direction="in">
+        <ip srcipaddr="10.0.0.0" srcipmask="255.255.255.248"/>
+    </rule>
+    <rule action="accept" direction="out">
+        <ip dstipaddr="10.0.0.0" dstipmask="255.255.255.248"/>
+    </rule>
+    <!-- drop all other traffic -->
+    <rule action="drop" direction="inout"/>
+</filter>
+"""
+
+GOLDEN_ACCESS_NWFILTER = """
+<filter name="vmnetnwfilter_3_access" chain="ipv4">
+    <uuid>01234567-89ab-cdef-0123-456789abcdef</uuid>
+    <rule action="accept" direction="in" priority="400">
+        <ip srcipaddr="172.16.0.5"/>
+    </rule>
+    <rule action="accept" direction="out" priority="400">
+        <ip dstipaddr="172.16.0.5"/>
+    </rule>
+</filter>
+"""
+
+GOLDEN_ACCESS_NWFILTER_EMPTY = """
+<filter name="vmnetnwfilter_3_access" chain="ipv4">
+    <uuid>01234567-89ab-cdef-0123-456789abcdef</uuid>
+</filter>
+"""
+
+
+def _xml_tree(xml):
+    # Whitespace and comments do not matter to libvirt
+    def convert(element):
+        return (element.tag, element.attrib, (element.text or '').strip(),
+                [convert(child) for child in element])
+    return convert(ET.fromstring(xml.strip()))
+
+
+class LibvirtXMLTest(SimpleTestCase):
+    def assertSameXML(self, xml, golden_xml):
+        self.assertEqual(_xml_tree(xml), _xml_tree(golden_xml))
+
+    def test_backing_volume(self):
+        xml = libvirtxml.backing_volume_xml('backing-foo-abc.qcow2', 1234)
+        self.assertSameXML(xml, GOLDEN_BACKING_VOLUME)
+
+    def test_volume(self):
+        xml = libvirtxml.volume_xml('vmimage_7.qcow2', 1234,
+                                    '/var/lib/insekta/backing-foo-abc.qcow2')
+        self.assertSameXML(xml, GOLDEN_VOLUME)
+
+    def test_domain(self):
+        for boot_type, golden_os in (('efi', GOLDEN_DOMAIN_OS_EFI),
+                                     ('mbr', GOLDEN_DOMAIN_OS_MBR)):
+            xml = libvirtxml.domain_xml(name='insekta_vm_7',
+                                        volume='/var/lib/insekta/vmimage_7.qcow2',
+                                        memory=256,
+                                        boot_type=boot_type,
+                                        network='insekta_vmnet_3',
+                                        mac='54:52:00:00:03:02',
+                                        nwfilter_name='vmnetnwfilter_3')
+            self.assertSameXML(xml, GOLDEN_DOMAIN.format(os=golden_os))
+
+    def test_domain_performance_profile(self):
+        xml = libvirtxml.domain_xml(name='insekta_vm_7',
+                                    volume='/var/lib/insekta/vmimage_7.qcow2',
+                                    memory=2048,
+                                    boot_type='mbr',
+                                    network='insekta_vmnet_3',
+                                    mac='54:52:00:00:03:02',
+                                    nwfilter_name='vmnetnwfilter_3',
+                                    vcpus=4,
+                                    cpuset='2-7',
+                                    iothreads=1,
+                                    disk_cache='none',
+                                    disk_io='native',
+                                    net_queues=4,
+                                    hugepages=True,
+                                    memballoon='free_page_reporting',
+                                    graphics=False)
+        domain = ET.fromstring(xml)
+        self.assertEqual(domain.find('vcpu').attrib, {'placement': 'static', 'cpuset': '2-7'})
+        self.assertEqual(domain.findtext('vcpu'), '4')
+        self.assertEqual(domain.findtext('iothreads'), '1')
+        self.assertIsNotNone(domain.find('memoryBacking/hugepages'))
+        self.assertEqual(domain.find('devices/disk/driver').attrib,
+                         {'name': 'qemu', 'type': 'qcow2', 'cache': 'none', 'io': 'native',
+                          'iothread': '1'})
+        self.assertEqual(domain.find('devices/interface/driver').attrib,
+                         {'name': 'vhost', 'queues': '4'})
+        self.assertEqual(domain.find('devices/memballoon').attrib,
+                         {'model': 'virtio', 'freePageReporting': 'on'})
+        self.assertIsNone(domain.find('devices/graphics'))
+
+    def test_domain_hotplugged_interface(self):
+        # Domains restored from a snapshot get their NIC after the restore
+        xml = libvirtxml.domain_xml(name='insekta_vm_7',
+                                    volume='/var/lib/insekta/vmimage_7.qcow2',
+                                    memory=256,
+                                    boot_type='mbr',
+                                    network=None,
+                                    mac=None,
+                                    nwfilter_name=None,
+                                    uuid='01234567-89ab-cdef-0123-456789abcdef')
+        domain = ET.fromstring(xml)
+        self.assertEqual(domain.findtext('uuid'), '01234567-89ab-cdef-0123-456789abcdef')
+        domain.remove(domain.find('uuid'))
+        self.assertIsNone(domain.find('devices/interface'))
+        interface = ET.fromstring(libvirtxml.interface_xml('insekta_vmnet_3', '54:52:00:00:03:02',
+                                                           'vmnetnwfilter_3'))
+        domain.find('devices').insert(1, interface)
+        self.assertSameXML(ET.tostring(domain, encoding='unicode'),
+                           GOLDEN_DOMAIN.format(os=GOLDEN_DOMAIN_OS_MBR))
+
+    def test_network(self):
+        xml = libvirtxml.network_xml(
+            name='insekta_vmnet_3',
+            hosts=[('54:52:00:00:03:00', 'vm00', ipaddress.IPv4Address('10.0.0.2')),
+                   ('54:52:00:00:03:01', 'vm01', ipaddress.IPv4Address('10.0.0.3'))],
+            network_mask=ipaddress.IPv4Address('255.255.255.248'),
+            network_gateway=ipaddress.IPv4Address('10.0.0.1'),
+            dhcp_range_start=ipaddress.IPv4Address('10.0.0.2'),
+            dhcp_range_end=ipaddress.IPv4Address('10.0.0.6'))
+        self.assertSameXML(xml, GOLDEN_NETWORK)
+
+    def test_nwfilter(self):
+        xml = libvirtxml.nwfilter_xml(
+            name='vmnetnwfilter_3',
+            uuid='01234567-89ab-cdef-0123-456789abcdef',
+            dhcp_server=ipaddress.IPv4Address('10.0.0.1'),
+            network_ips=[ipaddress.IPv4Address('10.0.0.2'), ipaddress.IPv4Address('10.0.0.3')],
+            network_address=ipaddress.IPv4Address('10.0.0.0'),
+            network_mask=ipaddress.IPv4Address('255.255.255.248'),
+            access_nwfilter_name='vmnetnwfilter_3_access')
+        self.assertSameXML(xml, GOLDEN_NWFILTER)
+
+    def test_nwfilter_ip_learning(self):
+        xml = libvirtxml.nwfilter_xml(
+            name='vmnetnwfilter_3',
+            uuid='01234567-89ab-cdef-0123-456789abcdef',
+            dhcp_server=ipaddress.IPv4Address('10.0.0.1'),
+            network_ips=[],
+            network_address=ipaddress.IPv4Address('10.0.0.0'),
+            network_mask=ipaddress.IPv4Address('255.255.255.248'))
+        self.assertSameXML(xml, GOLDEN_NWFILTER_IP_LEARNING)
+
+    def test_access_nwfilter(self):
+        xml = libvirtxml.access_nwfilter_xml(name='vmnetnwfilter_3_access',
+                                             uuid='01234567-89ab-cdef-0123-456789abcdef',
+                                             ip_address='172.16.0.5')
+        self.assertSameXML(xml, GOLDEN_ACCESS_NWFILTER)
+        xml = libvirtxml.access_nwfilter_xml(name='vmnetnwfilter_3_access',
+                                             uuid='01234567-89ab-cdef-0123-456789abcdef',
+                                             ip_address=None)
+        self.assertSameXML(xml, GOLDEN_ACCESS_NWFILTER_EMPTY)
+
+
+class ConnectionHandlerTest(SimpleTestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(virt, 'start_event_loop'),
+                        mock.patch.object(virt.libvirt, 'open')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        virt.libvirt.open.side_effect = lambda uri: mock.MagicMock()
+        self.handler = virt.ConnectionHandler({'default': 'test:///default'})
+
+    def test_connection_per_thread(self):
+        conn = self.handler['default']
+        self.assertIs(self.handler['default'], conn)
+        other_conns = []
+        thread = threading.Thread(target=lambda: other_conns.append(self.handler['default']))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_conns[0], conn)
+
+    def test_close_connections_of_exited_threads(self):
+        thread_conns = []
+        thread = threading.Thread(target=lambda: thread_conns.append(self.handler['default']))
+        thread.start()
+        thread.join()
+        libvirt_conn = thread_conns[0]._obj
+        libvirt_conn.close.assert_not_called()
+        # Cleaned up as soon as another thread needs a connection
+        self.handler['default']
+        libvirt_conn.unregisterCloseCallback.assert_called_once_with()
+        libvirt_conn.close.assert_called_once_with()
+        self.assertEqual(len(self.handler._thread_connections), 1)
+
+
+class MetricsTest(SimpleTestCase):
+    def test_sample_names_match_type(self):
+        with mock.patch.object(metrics, '_metrics', []):
+            counter = metrics.Counter('test_errors_total', 'Errors', ('method',))
+            histogram = metrics.Histogram('test_duration_seconds', 'Duration', buckets=(1,))
+            counter.inc(method='a')
+            histogram.observe(0.5)
+            lines = []
+            for metric in metrics._metrics:
+                metrics._render_metric(lines, metric.name, metric.type, metric.help,
+                                       metric.get_samples())
+        self.assertEqual(''.join(lines), (
+            '# HELP test_errors_total Errors\n'
+            '# TYPE test_errors_total counter\n'
+            'test_errors_total{method="a"} 1\n'
+            '# HELP test_duration_seconds Duration\n'
+            '# TYPE test_duration_seconds histogram\n'
+            'test_duration_seconds_bucket{le="1"} 1\n'
+            'test_duration_seconds_bucket{le="+Inf"} 1\n'
+            'test_duration_seconds_count 1\n'
+            'test_duration_seconds_sum 0.5\n'
+        ))
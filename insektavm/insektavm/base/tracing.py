@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+import contextvars
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+# Records a span for every libvirt call made while LIBVIRT_TRACING is enabled.
+# Spans are attached to the current trace (a request or a VM job) and logged as
+# JSON lines using the field names of OpenTelemetry spans.
+
+logger = logging.getLogger('insektavm.tracing')
+
+_current_trace = contextvars.ContextVar('insekta_trace', default=None)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_time = time.time()
+        self.spans = []
+
+
+def is_enabled():
+    return getattr(settings, 'LIBVIRT_TRACING', False)
+
+
+@contextmanager
+def trace(name):
+    # Traces can't be nested, the spans are attached to the outermost trace
+    if not is_enabled() or _current_trace.get() is not None:
+        yield _current_trace.get()
+        return
+    current_trace = Trace(name)
+    token = _current_trace.set(current_trace)
+    try:
+        yield current_trace
+    finally:
+        _current_trace.reset(token)
+        _log_span(current_trace.trace_id, current_trace.span_id, None, name,
+                  current_trace.start_time, time.time(), {
+                      'insekta.libvirt.num_calls': len(current_trace.spans),
+                      'insekta.libvirt.duration_ms': round(
+                          sum(span['duration_ms'] for span in current_trace.spans), 3),
+                  })
+
+
+def record_span(name, node, start_time, end_time, error_code=None):
+    current_trace = _current_trace.get()
+    attributes = {
+        'libvirt.node': node,
+        'libvirt.method': name,
+    }
+    if error_code is not None:
+        attributes['libvirt.error_code'] = error_code
+    if current_trace is not None:
+        current_trace.spans.append({
+            'name': name,
+            'node': node,
+            'duration_ms': (end_time - start_time) * 1000,
+            'error_code': error_code,
+        })
+        _log_span(current_trace.trace_id, os.urandom(8).hex(), current_trace.span_id,
+                  name, start_time, end_time, attributes, error_code is not None)
+    else:
+        _log_span(os.urandom(16).hex(), os.urandom(8).hex(), None,
+                  name, start_time, end_time, attributes, error_code is not None)
+
+
+def _log_span(trace_id, span_id, parent_span_id, name, start_time, end_time, attributes,
+              is_error=False):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info(json.dumps({
+        'trace_id': trace_id,
+        'span_id': span_id,
+        'parent_span_id': parent_span_id,
+        'name': name,
+        'start_time_unix_nano': int(start_time * 1e9),
+        'end_time_unix_nano': int(end_time * 1e9),
+        'attributes': attributes,
+        'status': {'code': 'ERROR' if is_error else 'OK'},
+    }))
+
+
+class TracingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_enabled():
+            return self.get_response(request)
+        with trace('{} {}'.format(request.method, request.path)):
+            return self.get_response(request)
@@ -1,3 +1,12 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from insektavm.base import metrics
+from insektavm.base.utils import http_basic_auth
+
+
+@require_GET
+@http_basic_auth(getattr(settings, 'METRICS_AUTH', settings.API_AUTH))
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
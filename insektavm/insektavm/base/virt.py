@@ -1,61 +1,249 @@
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+
 import libvirt
 import time
 
 from django.conf import settings
 
-NUM_RETRIES = 3
+from insektavm.base import metrics, tracing
+from insektavm.base.signals import connection_invalidated
+
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+LIBVIRT_CALL_DURATION = metrics.Histogram('insekta_libvirt_call_duration_seconds',
+                                          'Duration of libvirt calls',
+                                          ('node', 'method'))
+LIBVIRT_ERRORS = metrics.Counter('insekta_libvirt_errors_total',
+                                 'Failed libvirt calls', ('node', 'method'))
+
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
+
 
 class VirtError(Exception):
     pass
 
 
+class CapacityError(VirtError):
+    pass
+
+
+def start_event_loop():
+    # Keepalive messages and close callbacks need a running libvirt event loop.
+    # It has to be registered before the first connection is opened.
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        thread = threading.Thread(target=_run_event_loop, name='libvirt-events', daemon=True)
+        thread.start()
+        _event_loop_started = True
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+class _Connection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_closed = False
+
+    def on_close(self, connection, reason, opaque):
+        self.is_closed = True
+
+
+class _InstrumentedObject:
+    # Measures every call of a libvirt connection and of the domains, networks,
+    # pools, volumes, nwfilters and streams it returns
+    def __init__(self, obj, node):
+        self._obj = obj
+        self._node = node
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        method = '{}.{}'.format(type(self._obj).__name__, name)
+
+        def call(*args, **kwargs):
+            # libvirt functions taking other libvirt objects need the real ones
+            args = [_unwrap(arg) for arg in args]
+            kwargs = {key: _unwrap(value) for key, value in kwargs.items()}
+            return _instrumented_call(self._node, method, attr, args, kwargs)
+        return call
+
+    def __eq__(self, other):
+        return self._obj == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._obj)
+
+
+def _instrumented_call(node, method, func, args, kwargs):
+    start_time = time.monotonic()
+    error_code = None
+    try:
+        ret = func(*args, **kwargs)
+    except libvirt.libvirtError as e:
+        error_code = e.get_error_code()
+        LIBVIRT_ERRORS.inc(node=node, method=method)
+        raise
+    finally:
+        duration = time.monotonic() - start_time
+        LIBVIRT_CALL_DURATION.observe(duration, node=node, method=method)
+        if tracing.is_enabled():
+            end_time = time.time()
+            tracing.record_span(method, node, end_time - duration, end_time, error_code)
+    return _wrap(ret, node)
+
+
+def _wrap(obj, node):
+    if isinstance(obj, list):
+        return [_wrap(item, node) for item in obj]
+    if isinstance(obj, _get_wrapped_types()):
+        return _InstrumentedObject(obj, node)
+    return obj
+
+
+def _unwrap(obj):
+    if isinstance(obj, _InstrumentedObject):
+        return obj._obj
+    return obj
+
+
+def _get_wrapped_types():
+    return (libvirt.virDomain, libvirt.virNetwork, libvirt.virNWFilter,
+            libvirt.virStoragePool, libvirt.virStorageVol, libvirt.virStream)
+
+
+class _NodeHealth:
+    def __init__(self):
+        self.num_failures = 0
+        self.down_until = 0
+
+
 class ConnectionHandler:
     def __init__(self, libvirt_nodes):
         self.libvirt_nodes = libvirt_nodes
-        self._connections = {}
+        # libvirt connections are thread-safe, but a connection per thread keeps
+        # a slow call in one thread from blocking the calls of all other threads
+        self._local = threading.local()
+        # The connections of all threads, so those of exited threads can be closed
+        self._thread_connections = {}
+        self._health = {key: _NodeHealth() for key in libvirt_nodes}
+        self._lock = threading.Lock()
+        self._executors = {}
 
     def __getitem__(self, key):
-        try:
-            connection_url = self.libvirt_nodes[key]
-        except KeyError:
+        if key not in self.libvirt_nodes:
             raise VirtError('No such node')
-        if key not in self._connections:
-            connection = self.connect(connection_url)
-            self._connections[key] = connection
-
-        if self._connections[key].isAlive():
-            return self._connections[key]
-        else:
+        local_connections = self._get_local_connections()
+        conn = local_connections.get(key)
+        # Dead connections are detected by keepalive, no need for an isAlive() round trip
+        if conn is None or conn.is_closed:
             self.invalidate(key)
-            connection = self.connect(connection_url)
-            self._connections[key] = connection
-            return self._connections[key]
-
+            conn = self.connect(key)
+            local_connections[key] = conn
+        return conn.connection
 
     def invalidate(self, key):
-        if key in self._connections:
-            try:
-                self._connections[key].close()
-            except libvirt.libvirtError:
-                pass
-            del self._connections[key]
+        local_connections = self._get_local_connections()
+        conn = local_connections.pop(key, None)
+        if conn is not None:
+            self._close_connection(key, conn)
 
     def close(self):
-        for key in list(self._connections):
+        for key in list(self._get_local_connections()):
             self.invalidate(key)
 
-    def connect(self, connection_url):
-        num_tries = 0
-        while True:
-            try:
-                connection = libvirt.open(connection_url)
-                return connection
-            except libvirt.libvirtError:
-                if num_tries < NUM_RETRIES:
-                    num_tries += 1
-                    time.sleep(1)
-                    continue
-                else:
-                    raise VirtError("Could not connect to...")
+    def is_down(self, key):
+        with self._lock:
+            return self._health[key].down_until > time.monotonic()
+
+    def get_executor(self, key):
+        # Bounds the number of concurrent long-running operations per node
+        if key not in self.libvirt_nodes:
+            raise VirtError('No such node')
+        with self._lock:
+            if key not in self._executors:
+                max_workers = getattr(settings, 'LIBVIRT_MAX_PARALLEL', 4)
+                self._executors[key] = ThreadPoolExecutor(max_workers=max_workers,
+                                                          thread_name_prefix='libvirt-' + key)
+            return self._executors[key]
+
+    def connect(self, key):
+        # Fail fast while the node is known to be down instead of letting
+        # request threads pile up waiting for it
+        if self.is_down(key):
+            raise VirtError('Node {} is down'.format(key))
+        start_event_loop()
+        try:
+            connection = _instrumented_call(key, 'open', libvirt.open,
+                                            [self.libvirt_nodes[key]], {})
+        except libvirt.libvirtError:
+            self._mark_down(key)
+            raise VirtError('Could not connect to node {}'.format(key))
+        with self._lock:
+            self._health[key].num_failures = 0
+        conn = _Connection(_InstrumentedObject(connection, key))
+        try:
+            connection.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            connection.registerCloseCallback(conn.on_close, None)
+        except libvirt.libvirtError:
+            # Not supported by the driver, the connection is used until a call fails
+            pass
+        return conn
+
+    def _mark_down(self, key):
+        # Exponential backoff with jitter, so reconnects after an outage are spread out
+        with self._lock:
+            health = self._health[key]
+            health.num_failures += 1
+            backoff = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (health.num_failures - 1))
+            backoff = random.uniform(backoff / 2, backoff)
+            health.down_until = time.monotonic() + backoff
+
+    def _get_local_connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            pass
+        # First use in this thread, a good time to clean up after exited threads
+        self._close_exited_threads()
+        self._local.connections = {}
+        with self._lock:
+            self._thread_connections[threading.current_thread()] = self._local.connections
+        return self._local.connections
+
+    def _close_exited_threads(self):
+        with self._lock:
+            exited = [thread for thread in self._thread_connections if not thread.is_alive()]
+            exited_connections = [self._thread_connections.pop(thread) for thread in exited]
+        for local_connections in exited_connections:
+            for key, conn in list(local_connections.items()):
+                self._close_connection(key, conn)
+            local_connections.clear()
+
+    def _close_connection(self, key, conn):
+        connection_invalidated.send(sender=ConnectionHandler, node=key,
+                                    connection=conn.connection)
+        # The close callback keeps a reference to the connection
+        try:
+            conn.connection.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            conn.connection.close()
+        except libvirt.libvirtError:
+            pass
+
 
 connections = ConnectionHandler(settings.LIBVIRT_NODES)
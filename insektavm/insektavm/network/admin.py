@@ -4,12 +4,18 @@ from insektavm.network.models import Network, NetworkRange
 
 
 class NetworkRangeAdmin(admin.ModelAdmin):
-    list_display = ['name', 'network', 'subnet_prefix']
+    list_display = ['name', 'network', 'subnet_prefix', 'num_created_subnets']
     ordering = ['name']
 
+    def get_readonly_fields(self, request, obj=None):
+        # Existing networks are found by the index of their subnet
+        if obj is not None and obj.num_created_subnets:
+            return ['network', 'subnet_prefix', 'num_created_subnets']
+        return ['num_created_subnets']
+
 
 class NetworkAdmin(admin.ModelAdmin):
-    list_display = ['network', 'range', 'in_use']
+    list_display = ['network', 'range', 'in_use', 'node', 'slot']
 
 
 admin.site.register(Network, NetworkAdmin)
@@ -0,0 +1,43 @@
+import ipaddress
+import json
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from insektavm.base.benchmark import run_concurrent
+from insektavm.network.models import NetworkRange
+
+
+class Command(BaseCommand):
+    help = ('Measures how fast parallel clients can claim free networks. '
+            'Use PostgreSQL, SQLite serializes all writers. Runs in a temporary test '
+            'database, so live starts never get networks of the benchmark.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--claimers', type=int, default=100,
+                            help='Number of parallel claimers')
+        parser.add_argument('--claims', type=int, default=1000,
+                            help='Total number of networks to claim')
+        parser.add_argument('--network', default='10.255.0.0/16',
+                            help='Network of the temporary range used for the benchmark')
+        parser.add_argument('--prefix', type=int, default=28,
+                            help='Prefix length of the subnets')
+
+    def handle(self, **options):
+        # Like the test runner, this switches all connections to the test database
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                                      serialize=False)
+        try:
+            result = self._run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(json.dumps(result, indent=4))
+
+    def _run(self, options):
+        network_range = NetworkRange.objects.create(
+            name='benchmark-{}'.format(uuid.uuid4().hex[:8]),
+            network=ipaddress.IPv4Network(options['network']),
+            subnet_prefix=options['prefix'])
+        return run_concurrent(network_range.get_free_network,
+                              options['claims'], options['claimers'])
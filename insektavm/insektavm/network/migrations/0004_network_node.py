@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0003_alter_network_id_alter_networkrange_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='node',
+            field=models.CharField(default='default', max_length=40),
+        ),
+    ]
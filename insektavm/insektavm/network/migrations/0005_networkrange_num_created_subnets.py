@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+def count_created_subnets(apps, schema_editor):
+    # Ranges created so far had all their subnets created up front
+    NetworkRange = apps.get_model('network', 'NetworkRange')
+    for network_range in NetworkRange.objects.annotate(count=models.Count('subnet')):
+        network_range.num_created_subnets = network_range.count
+        network_range.save(update_fields=['num_created_subnets'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0004_network_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkrange',
+            name='num_created_subnets',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_created_subnets, migrations.RunPython.noop),
+    ]
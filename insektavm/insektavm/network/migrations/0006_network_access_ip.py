@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0005_networkrange_num_created_subnets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='access_ip',
+            field=models.CharField(blank=True, max_length=15, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+def set_slots_of_networks_in_use(apps, schema_editor):
+    # The libvirt objects of networks in use were named after the primary key
+    Network = apps.get_model('network', 'Network')
+    Network.objects.filter(in_use=True).update(slot=models.F('pk'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0006_network_access_ip'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='network',
+            name='slot',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_slots_of_networks_in_use, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='network',
+            constraint=models.UniqueConstraint(condition=models.Q(('in_use', True)), fields=('node', 'slot'), name='network_unique_slot_in_use'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('network', '0007_network_slot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='network',
+            index=models.Index(condition=models.Q(('in_use', False)), fields=['range', 'id'], name='network_free_idx'),
+        ),
+    ]
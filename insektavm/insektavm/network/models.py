@@ -1,20 +1,24 @@
+from collections.abc import Sequence
 import hashlib
 import ipaddress
 import subprocess
 import os
+import random
 
 import libvirt
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
-from django.db.models.signals import post_save
-from django.template.loader import render_to_string
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
 
-from insektavm.base.virt import connections
+from insektavm.base import libvirtxml, metrics
+from insektavm.base.virt import connections, CapacityError
 
 
 SCRIPT_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'scripts')
 
+# Slots are packed into two octets of the MACs
+MAX_SLOTS = 1 << 16
+
 
 class IPv4NetworkField(models.Field):
     def __init__(self, *args, **kwargs):
@@ -47,24 +51,72 @@ class NetworkRange(models.Model):
     name = models.CharField(max_length=40, unique=True)
     network = IPv4NetworkField()
     subnet_prefix = models.IntegerField()
+    # Subnets are only created as networks when they are needed for the first time
+    num_created_subnets = models.IntegerField(default=0)
 
-    @transaction.atomic
-    def create_subnets(self):
-        for subnet in self.network.subnets(new_prefix=self.subnet_prefix):
-            Network.objects.create(network=subnet, range=self)
-
-    @staticmethod
-    def post_save(sender, instance, created, **kwargs):
-        if created:
-            instance.create_subnets()
+    def clean(self):
+        if not isinstance(self.network, ipaddress.IPv4Network):
+            return
+        if not self.network.prefixlen <= self.subnet_prefix <= 30:
+            raise ValidationError({'subnet_prefix': 'Must be between the prefix length of '
+                                                    'the network and 30.'})
+        if self.pk is not None:
+            old = NetworkRange.objects.get(pk=self.pk)
+            if old.num_created_subnets and (old.network != self.network or
+                                            old.subnet_prefix != self.subnet_prefix):
+                raise ValidationError('The network can not be changed once subnets exist.')
+        for other in NetworkRange.objects.exclude(pk=self.pk):
+            if other.network.overlaps(self.network):
+                raise ValidationError({'network': 'Overlaps with range {}.'.format(other)})
+
+    def get_num_subnets(self):
+        return 1 << (self.subnet_prefix - self.network.prefixlen)
+
+    def get_subnet(self, index):
+        subnet_size = 1 << (32 - self.subnet_prefix)
+        network_address = int(self.network.network_address) + index * subnet_size
+        return ipaddress.IPv4Network((network_address, self.subnet_prefix))
 
     @transaction.atomic
-    def get_free_network(self):
-        # FIXME: Check if there are free networks
-        network = Network.objects.select_for_update().filter(in_use=False)[:1][0]
+    def get_free_network(self, node='default'):
+        # Concurrent claimers skip rows locked by others instead of all
+        # waiting for the same first free network
+        network = (Network.objects.select_for_update(skip_locked=True)
+                   .filter(range=self, in_use=False)
+                   .order_by('pk')
+                   .first())
+        if network is None:
+            network = self._create_next_network()
         network.in_use = True
-        network.save()
-        return network
+        network.node = node
+        # Concurrent claimers on the same node rarely pick the same slot, if
+        # they do, the unique constraint makes all but one of them pick again
+        while True:
+            network.slot = Network.get_free_slot(node)
+            try:
+                with transaction.atomic():
+                    network.save()
+            except IntegrityError:
+                continue
+            return network
+
+    def _create_next_network(self):
+        network_range = NetworkRange.objects.select_for_update().get(pk=self.pk)
+        index = network_range.num_created_subnets
+        if index >= self.get_num_subnets():
+            raise CapacityError('No free network left in range {}'.format(self.name))
+        network_range.num_created_subnets = index + 1
+        network_range.save(update_fields=['num_created_subnets'])
+        return Network.objects.create(network=self.get_subnet(index), range=self)
+
+    @classmethod
+    def allocate_network(cls, node='default'):
+        for network_range in cls.objects.order_by('name'):
+            try:
+                return network_range.get_free_network(node)
+            except CapacityError:
+                continue
+        raise CapacityError('No free network left')
 
     def __str__(self):
         return '{}: {}'.format(self.name, self.network)
@@ -74,43 +126,49 @@ class Network(models.Model):
     network = IPv4NetworkField()
     range = models.ForeignKey(NetworkRange, related_name='subnet', on_delete=models.CASCADE)
     in_use = models.BooleanField(default=False)
+    # The libvirt node the network is currently created on
+    node = models.CharField(max_length=40, default='default')
+    # User IP the access nwfilter currently allows, '' for none. None means that
+    # the filter state is unknown (e.g. networks created before the access filter existed).
+    access_ip = models.CharField(max_length=15, blank=True, null=True)
+    # Small number unique among the networks in use on a node. MACs and libvirt
+    # names are derived from it, so they don't grow with the primary key.
+    slot = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['node', 'slot'], condition=models.Q(in_use=True),
+                                    name='network_unique_slot_in_use'),
+        ]
+        indexes = [
+            # Free networks are claimed in primary key order
+            models.Index(fields=['range', 'id'], condition=models.Q(in_use=False),
+                         name='network_free_idx'),
+        ]
 
     def __str__(self):
         return str(self.network)
 
     def libvirt_get_name(self):
-        return '{}insekta_vmnet_{}'.format(settings.LIBVIRT_PREFIX, self.pk)
+        return '{}insekta_vmnet_{}'.format(settings.LIBVIRT_PREFIX, self._get_slot())
 
     def libvirt_create(self):
-        virtconn = connections['default']
+        virtconn = connections[self.node]
         network_name = self.libvirt_get_name()
         try:
             return virtconn.networkLookupByName(network_name)
         except libvirt.libvirtError as e:
             if e.get_error_code() != libvirt.VIR_ERR_NO_NETWORK:
                 raise
-        hosts = self.network.hosts()
-        network_gateway = next(hosts)
-        host_list = list(hosts)
-        first_host = host_list[0]
-        # Last host is reserved for the user, we don't want it to be taken by a vm
-        last_host = host_list.pop()
-        vm_hosts = []
-        for i, (host, mac) in enumerate(zip(host_list, self.get_macs())):
-            vm_hosts.append({
-                'addr': host,
-                'mac': mac,
-                'name': 'vm{}'.format(str(i).zfill(2))
-            })
-        network_xml = render_to_string('network/network.xml', {
-            'name': self.libvirt_get_name(),
-            'hosts': vm_hosts,
-            'network_address': str(self.network.network_address),
-            'network_mask': str(self.network.netmask),
-            'network_gateway': str(network_gateway),
-            'dhcp_range_start': first_host,
-            'dhcp_range_end': last_host
-        })
+        vm_hosts = ((self.get_mac(i), 'vm{}'.format(str(i).zfill(2)), ip)
+                    for i, ip in enumerate(self.get_vm_ips()))
+        # Last host is reserved for the user, but still part of the DHCP range
+        network_xml = libvirtxml.network_xml(name=self.libvirt_get_name(),
+                                             hosts=vm_hosts,
+                                             network_mask=self.network.netmask,
+                                             network_gateway=self.get_gateway(),
+                                             dhcp_range_start=self.get_gateway() + 1,
+                                             dhcp_range_end=self.get_user_ip())
         net = virtconn.networkDefineXML(network_xml)
         net.setAutostart(True)
         net.create()
@@ -118,7 +176,7 @@ class Network(models.Model):
         return net
 
     def libvirt_destroy(self):
-        virtconn = connections['default']
+        virtconn = connections[self.node]
         network_name = self.libvirt_get_name()
         try:
             net = virtconn.networkLookupByName(network_name)
@@ -139,62 +197,171 @@ class Network(models.Model):
         self.libvirt_destroy_nwfilter()
 
     def libvirt_get_nwfilter_name(self):
-        return '{}vmnetnwfilter_{}'.format(settings.LIBVIRT_PREFIX, self.pk)
+        return '{}vmnetnwfilter_{}'.format(settings.LIBVIRT_PREFIX, self._get_slot())
+
+    def libvirt_get_access_nwfilter_name(self):
+        return self.libvirt_get_nwfilter_name() + '_access'
 
     def libvirt_create_nwfilter(self, ip_address=None):
+        if not getattr(settings, 'LIBVIRT_NWFILTERS', True):
+            return None
+        # The rule for the user lives in a small filter of its own, so granting
+        # and revoking access does not redefine the large clean-traffic part
+        self.libvirt_create_access_nwfilter(ip_address)
         name = self.libvirt_get_nwfilter_name()
-        h = hashlib.sha256(name.encode()).hexdigest()
-        uuid = '{}-{}-{}-{}-{}'.format(h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
-        hosts = self.network.hosts()
-        dhcp_server = next(hosts)
-        network_ips = list(hosts)
-        nwfilter_xml = render_to_string('network/nwfilter.xml', {
-            'name': name,
-            'uuid': uuid,
-            'ip_address': ip_address,
-            'dhcp_server': str(dhcp_server),
-            'network_ips': network_ips,
-            'network_address': str(self.network.network_address),
-            'network_mask': str(self.network.netmask),
-        })
-        virtconn = connections['default']
+        # All hosts except the gateway, including the user
+        first_ip = int(self.get_gateway()) + 1
+        network_ips = _IndexedSequence(int(self.get_user_ip()) - first_ip + 1,
+                                       lambda i: ipaddress.IPv4Address(first_ip + i))
+        nwfilter_xml = libvirtxml.nwfilter_xml(
+            name=name,
+            uuid=_get_nwfilter_uuid(name),
+            dhcp_server=self.get_gateway(),
+            network_ips=network_ips,
+            network_address=self.network.network_address,
+            network_mask=self.network.netmask,
+            access_nwfilter_name=self.libvirt_get_access_nwfilter_name())
+        virtconn = connections[self.node]
         return virtconn.nwfilterDefineXML(nwfilter_xml)
 
+    def libvirt_create_access_nwfilter(self, ip_address=None):
+        if not getattr(settings, 'LIBVIRT_NWFILTERS', True):
+            return None
+        name = self.libvirt_get_access_nwfilter_name()
+        nwfilter_xml = libvirtxml.access_nwfilter_xml(name=name,
+                                                      uuid=_get_nwfilter_uuid(name),
+                                                      ip_address=ip_address)
+        virtconn = connections[self.node]
+        nwfilter = virtconn.nwfilterDefineXML(nwfilter_xml)
+        self.access_ip = ip_address or ''
+        Network.objects.filter(pk=self.pk).update(access_ip=self.access_ip)
+        return nwfilter
+
     def libvirt_destroy_nwfilter(self):
-        virtconn = connections['default']
-        try:
-            f = virtconn.nwfilterLookupByName(self.libvirt_get_nwfilter_name())
-        except libvirt.libvirtError:
-            pass
-        else:
-            f.undefine()
+        if not getattr(settings, 'LIBVIRT_NWFILTERS', True):
+            return
+        virtconn = connections[self.node]
+        # The access filter is referenced by the main filter, so it goes last
+        for name in (self.libvirt_get_nwfilter_name(), self.libvirt_get_access_nwfilter_name()):
+            try:
+                f = virtconn.nwfilterLookupByName(name)
+            except libvirt.libvirtError:
+                pass
+            else:
+                f.undefine()
+
+    def get_gateway(self):
+        return self.network.network_address + 1
+
+    def get_user_ip(self):
+        # Last host is reserved for the user, we don't want it to be taken by a vm
+        return self.network.broadcast_address - 1
 
-    def get_macs(self):
+    def get_vm_ip(self, index):
+        # First host is the gateway, last host might be a user
+        if not 0 <= index < self.get_num_vm_ips():
+            raise IndexError('No VM IP with index {} in {}'.format(index, self.network))
+        return self.network.network_address + 2 + index
+
+    def get_vm_ips(self):
+        return _IndexedSequence(self.get_num_vm_ips(), self.get_vm_ip)
+
+    def get_num_vm_ips(self):
+        return max(0, self.network.num_addresses - 4)
+
+    def get_mac(self, index):
         if self.network.num_addresses > 256:
             raise ValueError('Too large network to create MACs. Largest is /24.')
-        if self.pk >= (1 << 16):
-            raise ValueError('Network has a too large primary key. Max is 16 bit.')
-        assert self.pk < (1 << 16)
-        kvm_prefix = '54:52:00'
-        pk_higher = self.pk >> 8
-        pk_lower = self.pk & 0xff
-        return ['{}:{:0>2x}:{:0>2x}:{:0>2x}'.format(kvm_prefix, pk_higher, pk_lower, i)
-                for i in range(self.network.num_addresses)]
+        if not 0 <= index < self.network.num_addresses:
+            raise IndexError('No MAC with index {} in {}'.format(index, self.network))
+        slot = self._get_slot()
+        return '54:52:00:{:0>2x}:{:0>2x}:{:0>2x}'.format(slot >> 8, slot & 0xff, index)
 
-    def get_vm_ips(self):
-        # First host is the gateway, last host might be a user
-        return list(self.network.hosts())[1:-1]
+    def get_macs(self):
+        return _IndexedSequence(self.network.num_addresses, self.get_mac)
 
     def free(self):
-        self.in_use = False
         self.libvirt_destroy()
+        self.release()
+
+    def release(self):
+        # Gives the network back without touching libvirt
+        self.in_use = False
+        self.slot = None
+        self.access_ip = None
         self.save()
 
+    def _get_slot(self):
+        if self.slot is None:
+            raise ValueError('Network {} has no slot, it is not in use.'.format(self))
+        return self.slot
+
+    @classmethod
+    def get_free_slot(cls, node):
+        # A random free slot, so concurrent claimers rarely pick the same one and
+        # don't have to wait for each other on the unique constraint
+        used_slots = set(cls.objects.filter(node=node, in_use=True, slot__isnull=False)
+                         .values_list('slot', flat=True))
+        if len(used_slots) >= MAX_SLOTS:
+            raise CapacityError('No free network slot left on node {}'.format(node))
+        for i in range(16):
+            slot = random.randrange(MAX_SLOTS)
+            if slot not in used_slots:
+                return slot
+        # Almost all slots are used
+        return random.choice([slot for slot in range(MAX_SLOTS) if slot not in used_slots])
+
     def grant_access(self, ip_address):
-        self.libvirt_create_nwfilter(str(ip_address))
+        ip_address = str(ip_address)
+        if self.access_ip is None:
+            self.libvirt_create_nwfilter(ip_address)
+        elif self.access_ip != ip_address:
+            self.libvirt_create_access_nwfilter(ip_address)
 
     def revoke_access(self):
-        self.libvirt_create_nwfilter()
-
+        if self.access_ip is None:
+            self.libvirt_create_nwfilter()
+        elif self.access_ip:
+            self.libvirt_create_access_nwfilter()
+
+
+class _IndexedSequence(Sequence):
+    # Computes the items on access, so large subnets don't cost anything up front
+    def __init__(self, length, get_item):
+        self._length = length
+        self._get_item = get_item
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get_item(i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('Index out of range')
+        return self._get_item(index)
+
+
+@metrics.register_collector
+def _collect_metrics():
+    ranges = list(NetworkRange.objects.order_by('name'))
+    counts = {(network_range.name, state): 0
+              for network_range in ranges for state in ('in_use', 'free')}
+    rows = Network.objects.values('range__name', 'in_use').annotate(count=models.Count('pk'))
+    for row in rows:
+        counts[row['range__name'], 'in_use' if row['in_use'] else 'free'] = row['count']
+    return [
+        ('insekta_networks', 'Created networks per range',
+         [({'range': name, 'state': state}, count) for (name, state), count in counts.items()]),
+        ('insekta_network_range_subnets', 'Number of subnets a range can hold',
+         [({'range': network_range.name}, network_range.get_num_subnets())
+          for network_range in ranges]),
+    ]
+
+
+def _get_nwfilter_uuid(name):
+    h = hashlib.sha256(name.encode()).hexdigest()
+    return '{}-{}-{}-{}-{}'.format(h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
 
-post_save.connect(NetworkRange.post_save, sender=NetworkRange)
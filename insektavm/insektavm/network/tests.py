@@ -1,3 +1,105 @@
+import ipaddress
+from unittest import mock
+
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 
-# Create your tests here.
+from insektavm.base.virt import CapacityError
+from insektavm.network import models as network_models
+from insektavm.network.models import Network, NetworkRange
+
+
+class NetworkAllocationTest(TestCase):
+    def setUp(self):
+        # Four /30 subnets
+        self.network_range = NetworkRange.objects.create(
+            name='test', network=ipaddress.IPv4Network('10.0.0.0/28'), subnet_prefix=30)
+
+    def test_capacity_exhausted(self):
+        networks = [self.network_range.get_free_network() for i in range(4)]
+        self.assertEqual(len({network.pk for network in networks}), 4)
+        with self.assertRaises(CapacityError):
+            self.network_range.get_free_network()
+        with self.assertRaises(CapacityError):
+            NetworkRange.allocate_network()
+
+    def test_released_network_is_reused(self):
+        networks = [self.network_range.get_free_network() for i in range(4)]
+        networks[1].release()
+        self.assertEqual(self.network_range.get_free_network().pk, networks[1].pk)
+        self.assertEqual(Network.objects.count(), 4)
+
+    def test_allocate_from_next_range(self):
+        other_range = NetworkRange.objects.create(
+            name='test2', network=ipaddress.IPv4Network('10.1.0.0/30'), subnet_prefix=30)
+        for i in range(4):
+            self.network_range.get_free_network()
+        self.assertEqual(NetworkRange.allocate_network().range_id, other_range.pk)
+
+
+class NetworkRangeTest(TestCase):
+    def setUp(self):
+        self.network_range = NetworkRange.objects.create(
+            name='test', network=ipaddress.IPv4Network('10.0.0.0/24'), subnet_prefix=28)
+
+    def test_subnets(self):
+        self.assertEqual(self.network_range.get_num_subnets(), 16)
+        self.assertEqual(self.network_range.get_subnet(0), ipaddress.IPv4Network('10.0.0.0/28'))
+        self.assertEqual(self.network_range.get_subnet(15),
+                         ipaddress.IPv4Network('10.0.0.240/28'))
+
+    def test_subnets_created_lazily(self):
+        self.assertFalse(Network.objects.exists())
+        networks = [self.network_range.get_free_network() for i in range(3)]
+        self.assertEqual([network.network for network in networks],
+                         [self.network_range.get_subnet(i) for i in range(3)])
+        self.network_range.refresh_from_db()
+        self.assertEqual(self.network_range.num_created_subnets, 3)
+
+    def test_resize_with_subnets(self):
+        self.network_range.full_clean()
+        self.network_range.get_free_network()
+        self.network_range.refresh_from_db()
+        self.network_range.subnet_prefix = 29
+        with self.assertRaises(ValidationError):
+            self.network_range.full_clean()
+
+    def test_overlapping_range(self):
+        network_range = NetworkRange(name='test2', network=ipaddress.IPv4Network('10.0.0.128/25'),
+                                     subnet_prefix=28)
+        with self.assertRaises(ValidationError):
+            network_range.full_clean()
+
+
+class NetworkSlotTest(TestCase):
+    def setUp(self):
+        self.network_range = NetworkRange.objects.create(
+            name='test', network=ipaddress.IPv4Network('10.0.0.0/24'), subnet_prefix=28)
+
+    def test_slots_unique_per_node(self):
+        networks = [self.network_range.get_free_network() for i in range(8)]
+        self.assertEqual(len({network.slot for network in networks}), 8)
+        for network in networks:
+            self.assertTrue(0 <= network.slot < network_models.MAX_SLOTS)
+        self.assertEqual(len({network.get_mac(0) for network in networks}), 8)
+
+    def test_released_slot_is_reused(self):
+        with mock.patch.object(network_models, 'MAX_SLOTS', 2):
+            networks = [self.network_range.get_free_network() for i in range(2)]
+            slot = networks[0].slot
+            networks[0].release()
+            self.assertIsNone(networks[0].slot)
+            self.assertEqual(self.network_range.get_free_network().slot, slot)
+
+    def test_slots_per_node(self):
+        with mock.patch.object(network_models, 'MAX_SLOTS', 2):
+            networks = [self.network_range.get_free_network(node) for node in ('a', 'a', 'b', 'b')]
+        self.assertEqual({network.slot for network in networks[:2]}, {0, 1})
+        self.assertEqual({network.slot for network in networks[2:]}, {0, 1})
+
+    def test_slots_exhausted(self):
+        with mock.patch.object(network_models, 'MAX_SLOTS', 2):
+            for i in range(2):
+                self.network_range.get_free_network()
+            with self.assertRaises(CapacityError):
+                Network.get_free_slot('default')
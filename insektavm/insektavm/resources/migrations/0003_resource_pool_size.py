@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resources', '0002_alter_resource_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='pool_size',
+            field=models.PositiveIntegerField(default=0, help_text='Number of pre-started instances kept ready for new users'),
+        ),
+    ]
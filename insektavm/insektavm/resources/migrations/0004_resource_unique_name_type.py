@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:33
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resources', '0003_resource_pool_size'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='resource',
+            unique_together={('name', 'type')},
+        ),
+    ]
@@ -1,14 +1,39 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+
+from insektavm.base.cache import TTLCache
 
 
 RESOURCE_TYPE_CHOICES = (
     ('vmnet', 'Network of VMs'),
 )
 
+_resource_cache = TTLCache(getattr(settings, 'LOOKUP_CACHE_TTL', 60))
+
 
 class Resource(models.Model):
     name = models.CharField(max_length=120)
     type = models.CharField(max_length=20, choices=RESOURCE_TYPE_CHOICES)
+    pool_size = models.PositiveIntegerField(
+        default=0, help_text='Number of pre-started instances kept ready for new users')
+
+    class Meta:
+        unique_together = ('name', 'type')
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+    @classmethod
+    def get_cached(cls, name, type):
+        # Raises Resource.DoesNotExist like get(), unknown names are not cached
+        return _resource_cache.get((name, type), lambda: cls.objects.get(name=name, type=type))
+
+
+def _callback_resource_changed(sender, **kwargs):
+    # The name might have changed, so the old key is unknown
+    _resource_cache.clear()
+
+
+post_save.connect(_callback_resource_changed, sender=Resource)
+post_delete.connect(_callback_resource_changed, sender=Resource)
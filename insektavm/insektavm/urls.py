@@ -17,6 +17,7 @@ Including another URLconf
 from django.urls import path, include
 from django.contrib import admin
 
+from insektavm.base import views as base_views
 from insektavm.vm import apiurls as vm_apiurls
 from insektavm.vpn import apiurls as vpn_apiurls
 
@@ -24,5 +25,6 @@ from insektavm.vpn import apiurls as vpn_apiurls
 urlpatterns = [
     path('vmadmin/', admin.site.urls),
     path('api/1.0/vm/', include(vm_apiurls)),
-    path('api/1.0/vpn/', include(vpn_apiurls))
+    path('api/1.0/vpn/', include(vpn_apiurls)),
+    path('metrics', base_views.metrics_view, name='metrics')
 ]
@@ -6,7 +6,8 @@ from django.shortcuts import render, redirect
 from django import forms
 
 from insektavm.resources.models import Resource
-from insektavm.vm.models import VMTemplate, ActiveVMResource, VirtualMachine
+from insektavm.vm.models import (BOOT_MODE_CHOICES, VMTemplate, VMSnapshot, ActiveVMResource,
+                                 VirtualMachine, VMJob)
 
 
 class VMTemplateAdmin(admin.ModelAdmin):
@@ -18,6 +19,7 @@ class VMTemplateAdmin(admin.ModelAdmin):
             name = forms.CharField(max_length=40)
             memory = forms.IntegerField(initial=128, help_text='MiB')
             boot_type = forms.ChoiceField(choices=(('efi', 'EFI boot'), ('mbr', 'MBR boot')))
+            boot_mode = forms.ChoiceField(choices=BOOT_MODE_CHOICES)
             order_id = forms.IntegerField(initial=1)
             filename = forms.ChoiceField(choices=filename_choices)
 
@@ -31,6 +33,7 @@ class VMTemplateAdmin(admin.ModelAdmin):
                     name=form.cleaned_data['name'],
                     memory=form.cleaned_data['memory'],
                     boot_type=form.cleaned_data['boot_type'],
+                    boot_mode=form.cleaned_data['boot_mode'],
                     order_id=form.cleaned_data['order_id'],
                     image_filename=image_filename)
                 messages.success(request, 'VM Template successfully added.')
@@ -46,5 +49,7 @@ class VMTemplateAdmin(admin.ModelAdmin):
 
 
 admin.site.register(VMTemplate, VMTemplateAdmin)
+admin.site.register(VMSnapshot)
 admin.site.register(ActiveVMResource)
-admin.site.register(VirtualMachine)
\ No newline at end of file
+admin.site.register(VirtualMachine)
+admin.site.register(VMJob)
\ No newline at end of file
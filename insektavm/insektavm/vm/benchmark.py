@@ -0,0 +1,94 @@
+from contextlib import contextmanager
+import ipaddress
+from unittest import mock
+import uuid
+
+import libvirt
+from django.conf import settings
+from django.test.utils import override_settings
+
+from insektavm.base import libvirtxml
+from insektavm.base.virt import connections
+from insektavm.network.models import NetworkRange
+from insektavm.resources.models import Resource
+from insektavm.vm.models import ActiveVMResource, VMTemplate, STORAGE_POOL_NAME
+
+# Helpers for benchmarks and load tests against libvirt's test driver. The test
+# driver has no nwfilters, only knows "test" domains and its node has little
+# memory, so the VMs are tiny.
+
+
+def check_test_driver():
+    for node, uri in settings.LIBVIRT_NODES.items():
+        if not uri.startswith('test:'):
+            raise ValueError('Node {} does not use the libvirt test driver. Benchmarks '
+                             'create and destroy lots of VMs.'.format(node))
+
+
+@contextmanager
+def test_driver_settings():
+    with override_settings(LIBVIRT_NWFILTERS=False, LIBVIRT_DOMAIN_TYPE='test',
+                           LIBVIRT_RESERVED_MEMORY=0):
+        for node in settings.LIBVIRT_NODES:
+            _create_storage_pool(connections[node])
+        yield
+
+
+@contextmanager
+def stubbed_uploads():
+    # The test driver can't upload volumes, so uploads are skipped and only the
+    # local read, hash and segment pass of VMTemplate.from_image() is measured
+    def info_flags(volume, flags=0):
+        info = volume.info()
+        # The physical size is the capacity, as if the whole image was received
+        return [info[0], info[1], info[1]]
+
+    with mock.patch.object(libvirt.virStorageVol, 'upload'), \
+            mock.patch.object(libvirt.virStorageVol, 'infoFlags', info_flags), \
+            mock.patch.object(libvirt.virStream, 'send', lambda stream, data: len(data)), \
+            mock.patch.object(libvirt.virStream, 'sendHole'), \
+            mock.patch.object(libvirt.virStream, 'finish'), \
+            mock.patch.object(libvirt.virStream, 'abort'):
+        yield
+
+
+@contextmanager
+def temporary_resource(num_vms, network):
+    # A resource with num_vms templates sharing an empty backing volume, since
+    # the test driver can't upload images. Everything is removed afterwards.
+    slug = 'benchmark-{}'.format(uuid.uuid4().hex[:8])
+    resource = Resource.objects.create(name=slug, type='vmnet')
+    network_range = NetworkRange.objects.create(
+        name=slug, network=ipaddress.IPv4Network(network), subnet_prefix=28)
+    image_name = '{}{}.qcow2'.format(settings.LIBVIRT_PREFIX, slug)
+    for node in settings.LIBVIRT_NODES:
+        pool = connections[node].storagePoolLookupByName(STORAGE_POOL_NAME)
+        pool.createXML(libvirtxml.backing_volume_xml(image_name, 1 << 30))
+    for i in range(num_vms):
+        VMTemplate.objects.create(resource=resource, name='vm{}'.format(i), memory=8,
+                                  boot_type='mbr', image_fingerprint=image_name,
+                                  image_name=image_name, order_id=i)
+    try:
+        yield resource
+    finally:
+        for vm_res in ActiveVMResource.objects.filter(resource=resource):
+            vm_res.destroy()
+        # All templates share the backing volume, so it is deleted only once
+        vm_templates = list(VMTemplate.objects.filter(resource=resource))
+        image_names = set()
+        for vm_template in vm_templates:
+            if vm_template.get_image_filename() not in image_names:
+                image_names.add(vm_template.get_image_filename())
+                vm_template.delete_image()
+        resource.delete()
+        network_range.delete()
+
+
+def _create_storage_pool(virtconn):
+    try:
+        virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
+    except libvirt.libvirtError:
+        pool = virtconn.storagePoolDefineXML(
+            "<pool type='dir'><name>{0}</name><target><path>/{0}</path></target></pool>"
+            .format(STORAGE_POOL_NAME))
+        pool.create()
@@ -0,0 +1,92 @@
+import time
+
+import libvirt
+from django.db import close_old_connections
+
+from insektavm.base.virt import connections, VirtError
+from insektavm.vm.models import VirtualMachine
+
+
+def get_event_state(event, detail):
+    # Maps a lifecycle event to the state of the VM, None if it does not change it
+    if event in (libvirt.VIR_DOMAIN_EVENT_STARTED, libvirt.VIR_DOMAIN_EVENT_RESUMED):
+        return 'running'
+    elif event in (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED):
+        return 'paused'
+    elif event == libvirt.VIR_DOMAIN_EVENT_CRASHED:
+        return 'crashed'
+    elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+        if detail in (libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED,
+                      libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED):
+            return 'crashed'
+        return 'stopped'
+    return None
+
+
+def get_domain_state(state):
+    # Maps the state returned by virDomain.state() to the state of the VM
+    if state in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED):
+        return 'running'
+    elif state in (libvirt.VIR_DOMAIN_PAUSED, libvirt.VIR_DOMAIN_PMSUSPENDED):
+        return 'paused'
+    elif state == libvirt.VIR_DOMAIN_CRASHED:
+        return 'crashed'
+    return 'stopped'
+
+
+class DomainEventWatcher:
+    # Keeps VirtualMachine.state up to date for all VMs on one node. Lifecycle
+    # callbacks are called from the libvirt event loop thread.
+    def __init__(self, node):
+        self.node = node
+        self._connection = None
+        self._callback_id = None
+
+    def check(self):
+        # Registers the callback again after a reconnect. Events might have been
+        # lost in the meantime, so all states are synchronized as well.
+        virtconn = connections[self.node]
+        if virtconn is self._connection:
+            return
+        self._connection = None
+        self._callback_id = virtconn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._callback_lifecycle, None)
+        self._connection = virtconn
+        self.sync()
+
+    def sync(self):
+        states = {}
+        for dom in self._connection.listAllDomains():
+            pk = VirtualMachine.get_pk_from_domain_name(dom.name())
+            if pk is not None:
+                states[pk] = get_domain_state(dom.state()[0])
+        VirtualMachine.sync_states(self.node, states)
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.domainEventDeregisterAny(self._callback_id)
+            except libvirt.libvirtError:
+                pass
+            self._connection = None
+
+    def _callback_lifecycle(self, virtconn, dom, event, detail, opaque):
+        state = get_event_state(event, detail)
+        pk = VirtualMachine.get_pk_from_domain_name(dom.name())
+        if state is None or pk is None:
+            return
+        close_old_connections()
+        VirtualMachine.objects.filter(pk=pk).update(state=state)
+
+
+def watch(nodes, interval):
+    # Never returns. Nodes that are down are retried every interval seconds.
+    watchers = [DomainEventWatcher(node) for node in nodes]
+    while True:
+        for watcher in watchers:
+            try:
+                watcher.check()
+            except (VirtError, libvirt.libvirtError):
+                watcher.close()
+                connections.invalidate(watcher.node)
+        time.sleep(interval)
@@ -0,0 +1,146 @@
+from datetime import timedelta
+import itertools
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.timezone import now
+
+from insektavm.base.benchmark import get_percentiles, run_concurrent
+from insektavm.base.models import UserToken
+from insektavm.vm.benchmark import (check_test_driver, stubbed_uploads, temporary_resource,
+                                    test_driver_settings)
+from insektavm.vm.models import ActiveVMResource, VMTemplate
+from insektavm.vpn.signals import VPNSender, ip_assigned, ip_unassigned
+
+
+class Command(BaseCommand):
+    help = ('Measures starting, pinging and destroying VMs, importing templates and the '
+            'VPN callbacks. Only runs if all LIBVIRT_NODES use the libvirt test driver '
+            '(e.g. test:///default), which has no nwfilters and only "test" domains.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=10,
+                            help='Number of parallel callers')
+        parser.add_argument('--resources', type=int, default=100,
+                            help='Number of VM resources to start, ping and destroy')
+        parser.add_argument('--vms', type=int, default=2,
+                            help='Number of VMs per resource')
+        parser.add_argument('--imports', type=int, default=4,
+                            help='Number of templates to import from an image, the upload '
+                                 'to the test driver is skipped')
+        parser.add_argument('--image-size', type=int, default=16,
+                            help='Size of the imported image in MiB')
+        parser.add_argument('--expire-runs', type=int, default=5,
+                            help='Number of destroy_expired runs, each over freshly expired '
+                                 'resources')
+        parser.add_argument('--network', default='10.254.0.0/16',
+                            help='Network of the temporary range used for the benchmark')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, **options):
+        try:
+            check_test_driver()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        with test_driver_settings():
+            with temporary_resource(options['vms'], options['network']) as resource:
+                results = self._run(resource, options)
+
+        report = {
+            'nodes': settings.LIBVIRT_NODES,
+            'database': connection.vendor,
+            'concurrency': options['concurrency'],
+            'results': results,
+        }
+        self.stdout.write(json.dumps(report, indent=4))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=4)
+
+    def _run(self, resource, options):
+        concurrency = options['concurrency']
+        num_resources = options['resources']
+        results = {}
+
+        with tempfile.NamedTemporaryFile(suffix='.qcow2') as image, stubbed_uploads():
+            # Half data, half hole
+            image.write(os.urandom(options['image_size'] * 1024 * 1024 // 2))
+            image.truncate(options['image_size'] * 1024 * 1024)
+            image.flush()
+            counter = itertools.count()
+            results['from_image'] = run_concurrent(
+                lambda: VMTemplate.from_image(resource, 'import{}'.format(next(counter)),
+                                              memory=64, boot_type='mbr', order_id=1000,
+                                              image_filename=image.name),
+                options['imports'], concurrency)
+        # The imported templates have empty volumes, they are not used for VMs
+        for vm_template in VMTemplate.objects.filter(resource=resource, order_id=1000):
+            vm_template.delete_image()
+            vm_template.delete()
+
+        user_tokens = [UserToken.get_or_create_cached('{}-user{}'.format(resource.name, i))
+                       for i in range(num_resources)]
+        counter = itertools.count()
+        results['start_for'] = run_concurrent(
+            lambda: ActiveVMResource.start_for(resource, user_tokens[next(counter)]),
+            num_resources, concurrency)
+
+        vm_resources = list(ActiveVMResource.objects.filter(resource=resource)
+                            .select_related('network'))
+        counter = itertools.count()
+        results['ping'] = run_concurrent(
+            lambda: vm_resources[next(counter)].ping(), len(vm_resources), concurrency)
+
+        counter = itertools.count()
+        results['vpn_assign'] = run_concurrent(
+            lambda: self._assign_ip(user_tokens, next(counter)), num_resources, concurrency)
+        counter = itertools.count()
+        results['vpn_unassign'] = run_concurrent(
+            lambda: ip_unassigned.send(VPNSender, user_token=user_tokens[next(counter)]),
+            num_resources, concurrency)
+
+        # Destroy the first half one by one, let the rest expire
+        num_destroyed = len(vm_resources) // 2
+        counter = itertools.count()
+        results['destroy'] = run_concurrent(
+            lambda: vm_resources[next(counter)].destroy(), num_destroyed, concurrency)
+        num_expired = len(vm_resources) - num_destroyed
+        results['destroy_expired'] = self._destroy_expired(resource, num_expired,
+                                                           options['expire_runs'], concurrency)
+
+        return results
+
+    def _destroy_expired(self, resource, num_expired, num_runs, concurrency):
+        # Every run gets as many expired resources as the first one, the rest of the
+        # resources started before
+        latencies = []
+        for i in range(num_runs):
+            if i > 0:
+                user_tokens = [UserToken.get_or_create_cached('{}-expire{}-{}'.format(
+                    resource.name, i, j)) for j in range(num_expired)]
+                counter = itertools.count()
+                run_concurrent(
+                    lambda: ActiveVMResource.start_for(resource, user_tokens[next(counter)]),
+                    num_expired, concurrency)
+            (ActiveVMResource.objects.filter(resource=resource)
+             .update(expire_time=now() - timedelta(minutes=1)))
+            start_time = time.perf_counter()
+            ActiveVMResource.destroy_expired()
+            latencies.append(time.perf_counter() - start_time)
+        latencies.sort()
+        return {
+            'runs': num_runs,
+            'destroyed_per_run': num_expired,
+            'latency_ms': get_percentiles(latencies),
+        }
+
+    def _assign_ip(self, user_tokens, i):
+        # Like the VPN API, the addresses come from a range of their own
+        ip_address = '10.253.{}.{}'.format(i // 250, i % 250 + 1)
+        ip_assigned.send(VPNSender, user_token=user_tokens[i], ip_address=ip_address)
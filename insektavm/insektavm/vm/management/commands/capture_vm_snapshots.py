@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import os
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from insektavm.vm.models import VMSnapshot, VMTemplate
+
+
+class Command(BaseCommand):
+    help = ('Captures the missing snapshots of templates restored from snapshots and '
+            'deletes unused ones that are no longer needed or outdated.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--boot-time', type=int, default=60,
+                            help='Seconds the guest gets to boot before it is saved')
+        parser.add_argument('--parallel', type=int, default=4,
+                            help='Number of snapshots captured at the same time')
+
+    def handle(self, **options):
+        lock_file = os.path.join(tempfile.gettempdir(),
+                                 'insekta-capture-vm-snapshots.lock')
+
+        with open(lock_file, 'w') as f:
+            try:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                sys.exit(1)
+            else:
+                self._delete_unneeded()
+                self._capture_missing(options['boot_time'], options['parallel'])
+            finally:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+            sys.exit(0)
+
+    def _delete_unneeded(self):
+        copies = getattr(settings, 'VM_SNAPSHOT_COPIES', 4)
+        unused = (VMSnapshot.objects.filter(virtualmachine__isnull=True)
+                  .select_related('template__resource'))
+        for snapshot in unused:
+            template = snapshot.template
+            # Snapshots of templates whose profile was edited are captured again
+            if (template.boot_mode == 'snapshot' and snapshot.index < copies and
+                    snapshot.node in settings.LIBVIRT_NODES and
+                    snapshot.profile_hash == template.get_profile_hash()):
+                continue
+            snapshot.delete_volumes()
+            snapshot.delete()
+            self.stdout.write('Deleted snapshot {}'.format(snapshot))
+
+    def _capture_missing(self, boot_time, parallel):
+        copies = getattr(settings, 'VM_SNAPSHOT_COPIES', 4)
+        missing = []
+        for template in VMTemplate.objects.filter(boot_mode='snapshot').select_related('resource'):
+            existing = set(template.vmsnapshot_set.values_list('node', 'index'))
+            for node in settings.LIBVIRT_NODES:
+                for index in range(copies):
+                    if (node, index) not in existing:
+                        missing.append((template, node, index))
+
+        def capture(args):
+            try:
+                return VMSnapshot.capture(*args, boot_time=boot_time)
+            finally:
+                # Every thread has its own database connection
+                connection.close()
+
+        # Most of the time is spent waiting for the guests to boot
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            for snapshot in executor.map(capture, missing):
+                self.stdout.write('Captured snapshot {}'.format(snapshot))
@@ -5,7 +5,7 @@ import tempfile
 
 from django.core.management.base import BaseCommand
 
-from insektavm.vm.models import ActiveVMResource
+from insektavm.vm.models import ActiveVMResource, VMJob
 
 class Command(BaseCommand):
     def handle(self, **options):
@@ -19,6 +19,8 @@ class Command(BaseCommand):
                 sys.exit(1)
             else:
                 num_deleted = ActiveVMResource.destroy_expired()
+                # Finished jobs are only kept for the status API
+                VMJob.prune()
                 print(num_deleted)
             finally:
                 fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,34 @@
+import fcntl
+import os
+import sys
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from insektavm.vm.models import ActiveVMResource
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running and refill the pools every INTERVAL seconds')
+
+    def handle(self, **options):
+        lock_file =  os.path.join(tempfile.gettempdir(),
+                                  'insekta-fill-vm-pools.lock')
+
+        with open(lock_file, 'w') as f:
+            try:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                sys.exit(1)
+            else:
+                while True:
+                    num_started = ActiveVMResource.fill_pools()
+                    print(num_started)
+                    if not options['interval']:
+                        break
+                    time.sleep(options['interval'])
+            finally:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+            sys.exit(0)
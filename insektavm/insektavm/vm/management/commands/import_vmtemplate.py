@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from insektavm.resources.models import Resource
+from insektavm.vm.models import VMTemplate
+
+
+class Command(BaseCommand):
+    help = 'Imports a VM image as template of a resource and uploads it to all nodes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', help='Name of the resource')
+        parser.add_argument('name', help='Name of the VM')
+        parser.add_argument('image_filename', help='qcow2 image to import')
+        parser.add_argument('--memory', type=int, default=128, help='Memory in MiB')
+        parser.add_argument('--boot-type', choices=('efi', 'mbr'), default='efi')
+        parser.add_argument('--boot-mode', choices=('cold', 'snapshot'), default='cold',
+                            help='Restore VMs from snapshots taken by capture_vm_snapshots')
+        parser.add_argument('--order-id', type=int, default=1)
+
+    def handle(self, **options):
+        try:
+            resource = Resource.objects.get(name=options['resource'], type='vmnet')
+        except Resource.DoesNotExist:
+            raise CommandError('No such resource: {}'.format(options['resource']))
+
+        last_percent = None
+
+        def progress(bytes_done, file_size):
+            nonlocal last_percent
+            percent = bytes_done * 100 // file_size
+            if percent != last_percent:
+                self.stdout.write('\r{}%'.format(percent), ending='')
+                self.stdout.flush()
+                last_percent = percent
+
+        vm_template = VMTemplate.from_image(resource=resource,
+                                            name=options['name'],
+                                            memory=options['memory'],
+                                            boot_type=options['boot_type'],
+                                            boot_mode=options['boot_mode'],
+                                            order_id=options['order_id'],
+                                            image_filename=options['image_filename'],
+                                            progress=progress)
+        self.stdout.write('')
+        self.stdout.write('Imported {} with fingerprint {}'.format(
+            vm_template, vm_template.image_fingerprint))
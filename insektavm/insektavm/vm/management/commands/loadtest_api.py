@@ -0,0 +1,225 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import base64
+import json
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test.utils import override_settings
+
+from insektavm.base.benchmark import get_percentiles
+from insektavm.vm.benchmark import check_test_driver, temporary_resource, test_driver_settings
+
+ACTIONS = ('assign', 'start', 'status', 'ping', 'stop', 'unassign')
+
+
+class Command(BaseCommand):
+    help = ('Simulates a classroom: every virtual user assigns a VPN IP, starts a resource, '
+            'polls its status, pings it, stops it and unassigns the IP using the REST API. '
+            'Without --url, the API is served by a WSGI server in this process, backed '
+            'by the libvirt test driver, and the time spent waiting for row locks is '
+            'measured as well.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=30,
+                            help='Number of virtual users running at the same time')
+        parser.add_argument('--ramp-up', type=float, default=5,
+                            help='Seconds until all users have started their session')
+        parser.add_argument('--status-polls', type=int, default=3,
+                            help='Status requests per session after starting')
+        parser.add_argument('--pings', type=int, default=5,
+                            help='Pings per session')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds between status polls and pings')
+        parser.add_argument('--vms', type=int, default=2,
+                            help='Number of VMs of the temporary resource')
+        parser.add_argument('--network', default='10.254.0.0/16',
+                            help='Network of the temporary range')
+        parser.add_argument('--url',
+                            help='Base URL of a running server (e.g. gunicorn) instead of '
+                                 'the in-process server, e.g. http://localhost:8000/. With '
+                                 'VM_ASYNC_JOBS, run_vm_jobs has to run as well.')
+        parser.add_argument('--resource',
+                            help='Resource to start when using --url')
+        parser.add_argument('--server-threads', type=int, default=8,
+                            help='Number of threads of the in-process server, like the '
+                                 'workers of a threaded gunicorn')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, **options):
+        auth = base64.b64encode(':'.join(settings.API_AUTH).encode()).decode()
+        if options['url']:
+            if not options['resource']:
+                raise CommandError('--resource is required with --url')
+            session = _Session(options['url'], 'Basic ' + auth, options)
+            report = session.run(options['resource'])
+        else:
+            try:
+                check_test_driver()
+            except ValueError as e:
+                raise CommandError(str(e))
+            # Without a job worker, async starts would only measure enqueueing the jobs
+            with test_driver_settings(), override_settings(ALLOWED_HOSTS=['127.0.0.1'],
+                                                           VM_ASYNC_JOBS=False):
+                with temporary_resource(options['vms'], options['network']) as resource:
+                    report = self._run_local(resource, 'Basic ' + auth, options)
+            report['database'] = connection.vendor
+
+        self.stdout.write(json.dumps(report, indent=4))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=4)
+
+    def _run_local(self, resource, auth, options):
+        lock_waits = []
+        application = _LockWaitMiddleware(get_wsgi_application(), lock_waits)
+        server = make_server('127.0.0.1', 0, application, server_class=_PooledWSGIServer,
+                             handler_class=_QuietRequestHandler)
+        server.executor = ThreadPoolExecutor(max_workers=options['server_threads'],
+                                             thread_name_prefix='loadtest-server')
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/'.format(server.server_port)
+            report = _Session(url, auth, options).run(resource.name)
+        finally:
+            server.shutdown()
+            server.executor.shutdown()
+            server.server_close()
+        lock_waits.sort()
+        report['lock_wait'] = {
+            'queries': len(lock_waits),
+            'total_ms': sum(lock_waits) * 1000,
+            'latency_ms': get_percentiles(lock_waits),
+        }
+        return report
+
+
+class _Session:
+    def __init__(self, url, auth, options):
+        self.url = url.rstrip('/') + '/'
+        self.auth = auth
+        self.options = options
+        self.run_id = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._latencies = {action: [] for action in ACTIONS}
+        self._errors = {action: {} for action in ACTIONS}
+
+    def run(self, resource_name):
+        num_users = self.options['users']
+        start_time = time.perf_counter()
+        threads = []
+        for i in range(num_users):
+            thread = threading.Thread(target=self._run_user, args=(resource_name, i))
+            thread.start()
+            threads.append(thread)
+            time.sleep(self.options['ramp_up'] / num_users)
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start_time
+
+        num_requests = sum(len(latencies) for latencies in self._latencies.values())
+        num_errors = sum(sum(errors.values()) for errors in self._errors.values())
+        return {
+            'users': num_users,
+            'duration': duration,
+            'requests': num_requests + num_errors,
+            'throughput': num_requests / duration if duration else 0,
+            'error_rate': (num_errors / (num_requests + num_errors)
+                           if num_requests + num_errors else 0),
+            'actions': {
+                action: {
+                    'requests': len(self._latencies[action]),
+                    'errors': self._errors[action],
+                    'latency_ms': get_percentiles(sorted(self._latencies[action])),
+                } for action in ACTIONS
+            },
+        }
+
+    def _run_user(self, resource_name, i):
+        params = {'resource': resource_name,
+                  'username': 'loadtest-{}-{}'.format(self.run_id, i)}
+        # Like the VPN API, the addresses come from a range of their own
+        ip_address = '10.252.{}.{}'.format(i // 250, i % 250 + 1)
+        self._request('assign', 'api/1.0/vpn/assign',
+                      {'username': params['username'], 'ip_address': ip_address})
+        self._request('start', 'api/1.0/vm/start', params)
+        for j in range(self.options['status_polls']):
+            time.sleep(self.options['interval'])
+            self._request('status', 'api/1.0/vm/status?' + urlencode(params))
+        for j in range(self.options['pings']):
+            time.sleep(self.options['interval'])
+            self._request('ping', 'api/1.0/vm/ping', params)
+        self._request('stop', 'api/1.0/vm/stop', params)
+        self._request('unassign', 'api/1.0/vpn/unassign', {'username': params['username']})
+
+    def _request(self, action, path, data=None):
+        body = urlencode(data).encode() if data is not None else None
+        request = Request(self.url + path, data=body, headers={'Authorization': self.auth})
+        start_time = time.perf_counter()
+        try:
+            with urlopen(request, timeout=300) as resp:
+                resp.read()
+            error = None
+        except HTTPError as e:
+            error = str(e.code)
+        except (URLError, OSError) as e:
+            error = type(e).__name__
+        latency = time.perf_counter() - start_time
+        with self._lock:
+            if error is None:
+                self._latencies[action].append(latency)
+            else:
+                self._errors[action][error] = self._errors[action].get(error, 0) + 1
+
+
+class _PooledWSGIServer(WSGIServer):
+    # A fixed number of threads handles the requests, so their libvirt and
+    # database connections are reused instead of opened for every request
+    request_queue_size = 128
+    executor = None
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _LockWaitMiddleware:
+    # Measures the queries taking row locks. With many users waiting for the
+    # same rows, most of their time is spent waiting for the lock.
+    def __init__(self, application, lock_waits):
+        self.application = application
+        self.lock_waits = lock_waits
+
+    def __call__(self, environ, start_response):
+        with connection.execute_wrapper(self._measure):
+            return self.application(environ, start_response)
+
+    def _measure(self, execute, sql, params, many, context):
+        if 'FOR UPDATE' not in sql:
+            return execute(sql, params, many, context)
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.lock_waits.append(time.perf_counter() - start_time)
@@ -0,0 +1,75 @@
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from insektavm.vm.models import VMJob
+
+HEARTBEAT_INTERVAL = 30
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=getattr(settings, 'VM_JOB_WORKERS', 4),
+                            help='Number of jobs running concurrently')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds to wait before looking for new jobs')
+
+    def handle(self, **options):
+        lock_file = os.path.join(tempfile.gettempdir(),
+                                 'insekta-run-vm-jobs.lock')
+
+        with open(lock_file, 'w') as f:
+            try:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                sys.exit(1)
+            else:
+                self._run(options['workers'], options['interval'])
+            finally:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+            sys.exit(0)
+
+    def _run(self, num_workers, interval):
+        self._running_pks = set()
+        self._running_lock = threading.Lock()
+        threads = [threading.Thread(target=self._heartbeat, daemon=True)]
+        for i in range(num_workers):
+            threads.append(threading.Thread(target=self._work, args=(interval,), daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _heartbeat(self):
+        # Other workers, e.g. on another host, only requeue jobs without heartbeat
+        while True:
+            close_old_connections()
+            with self._running_lock:
+                running_pks = list(self._running_pks)
+            if running_pks:
+                VMJob.heartbeat(running_pks)
+            VMJob.requeue_stale()
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def _work(self, interval):
+        while True:
+            close_old_connections()
+            job = VMJob.claim_next()
+            if job is None:
+                time.sleep(interval)
+                continue
+            with self._running_lock:
+                self._running_pks.add(job.pk)
+            try:
+                job.run()
+            finally:
+                with self._running_lock:
+                    self._running_pks.discard(job.pk)
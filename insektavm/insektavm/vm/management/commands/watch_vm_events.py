@@ -0,0 +1,31 @@
+import fcntl
+import os
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from insektavm.vm.events import watch
+
+
+class Command(BaseCommand):
+    help = 'Keep the states of all VMs up to date using libvirt lifecycle events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between checks for lost node connections')
+
+    def handle(self, **options):
+        lock_file = os.path.join(tempfile.gettempdir(),
+                                 'insekta-watch-vm-events.lock')
+
+        with open(lock_file, 'w') as f:
+            try:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                sys.exit(1)
+            else:
+                watch(settings.LIBVIRT_NODES, options['interval'])
+            finally:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_alter_usertoken_id'),
+        ('vm', '0006_alter_activevmresource_id_alter_virtualmachine_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activevmresource',
+            name='user_token',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.usertoken'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_alter_usertoken_id'),
+        ('resources', '0003_resource_pool_size'),
+        ('vm', '0007_alter_activevmresource_user_token'),
+    ]
+
+    operations = [
+        # Existing VMs were booted synchronously, so they are running
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('booting', 'Booting'), ('running', 'Running'), ('failed', 'Failed')], default='running', max_length=8),
+        ),
+        migrations.AlterField(
+            model_name='virtualmachine',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('booting', 'Booting'), ('running', 'Running'), ('failed', 'Failed')], default='pending', max_length=8),
+        ),
+        migrations.CreateModel(
+            name='VMJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('start', 'Start'), ('stop', 'Stop')], max_length=8)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=8)),
+                ('error', models.TextField(blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('finished_time', models.DateTimeField(blank=True, null=True)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='resources.resource')),
+                ('user_token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.usertoken')),
+            ],
+        ),
+    ]
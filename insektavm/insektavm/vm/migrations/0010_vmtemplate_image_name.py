@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0009_activevmresource_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='image_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0010_vmtemplate_image_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='virtualmachine',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('booting', 'Booting'), ('running', 'Running'), ('paused', 'Paused'), ('stopped', 'Stopped'), ('crashed', 'Crashed'), ('failed', 'Failed')], default='pending', max_length=8),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_alter_usertoken_id'),
+        ('network', '0008_hot_query_indexes'),
+        ('resources', '0004_resource_unique_name_type'),
+        ('vm', '0011_vm_lifecycle_states'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activevmresource',
+            index=models.Index(condition=models.Q(('user_token__isnull', False)), fields=['expire_time'], name='vm_res_expire_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activevmresource',
+            index=models.Index(fields=['user_token', 'is_started'], name='vm_res_user_started_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_alter_usertoken_id'),
+        ('resources', '0004_resource_unique_name_type'),
+        ('vm', '0012_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vmjob',
+            name='state',
+            field=models.CharField(choices=[('waiting', 'Waiting for capacity'), ('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=8),
+        ),
+        migrations.AddIndex(
+            model_name='vmjob',
+            index=models.Index(condition=models.Q(('state', 'waiting')), fields=['id'], name='vm_job_waiting_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:50
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0013_vmjob_waiting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='boot_mode',
+            field=models.CharField(choices=[('cold', 'Cold boot'), ('snapshot', 'Restore from snapshot')], default='cold', max_length=8),
+        ),
+        migrations.CreateModel(
+            name='VMSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node', models.CharField(max_length=40)),
+                ('index', models.PositiveIntegerField()),
+                ('uuid', models.UUIDField(default=uuid.uuid4)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='vm.vmtemplate')),
+            ],
+            options={
+                'unique_together': {('template', 'node', 'index')},
+            },
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='snapshot',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='vm.vmsnapshot'),
+        ),
+    ]
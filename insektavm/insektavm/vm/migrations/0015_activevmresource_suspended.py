@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0014_vm_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activevmresource',
+            name='suspended',
+            field=models.CharField(blank=True, choices=[('pause', 'Paused'), ('managedsave', 'Saved to disk')], max_length=12),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0015_activevmresource_suspended'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='cpuset',
+            field=models.CharField(blank=True, help_text='Host CPUs the vCPUs are pinned to, e.g. 2-7,^4', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='disk_cache',
+            field=models.CharField(blank=True, choices=[('', 'Default'), ('none', 'None'), ('writeback', 'Writeback'), ('unsafe', 'Unsafe')], max_length=10),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='disk_io',
+            field=models.CharField(blank=True, choices=[('', 'Default'), ('native', 'Native'), ('threads', 'Threads'), ('io_uring', 'io_uring')], help_text='Native requires the disk cache to be none', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='graphics',
+            field=models.BooleanField(default=True, help_text='VNC console'),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='hugepages',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='iothreads',
+            field=models.PositiveSmallIntegerField(default=0, help_text='0 runs disk IO in the main loop'),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='memballoon',
+            field=models.CharField(blank=True, choices=[('', 'Default'), ('none', 'None'), ('free_page_reporting', 'Free page reporting')], max_length=20),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='net_queues',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Queues of the virtio NIC'),
+        ),
+        migrations.AddField(
+            model_name='vmtemplate',
+            name='vcpus',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
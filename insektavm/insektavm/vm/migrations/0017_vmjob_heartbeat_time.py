@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0016_vmtemplate_performance_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmjob',
+            name='heartbeat_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0017_vmjob_heartbeat_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vmjob',
+            name='action',
+            field=models.CharField(choices=[('start', 'Start'), ('stop', 'Stop'), ('suspend', 'Suspend'), ('resume', 'Resume')], max_length=8),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0018_vmjob_suspend_resume'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmsnapshot',
+            name='profile_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vm', '0019_vmsnapshot_profile_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node', models.CharField(max_length=40, unique=True)),
+            ],
+        ),
+    ]
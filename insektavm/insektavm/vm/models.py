@@ -1,22 +1,99 @@
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+import contextvars
 from datetime import timedelta
+import errno
 import hashlib
+import json
+import os
 import re
+import threading
+import time
+import uuid
 
 import libvirt
-from django.db import models, transaction
-from django.template.loader import render_to_string
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
 from django.utils.timezone import now
 from django.conf import settings
 
-from insektavm.base.virt import connections, VirtError
+from insektavm.base import libvirtxml, metrics, tracing
+from insektavm.base.signals import connection_invalidated
+from insektavm.base.virt import connections, CapacityError, VirtError
 from insektavm.base.models import UserToken
 from insektavm.resources.models import Resource
 from insektavm.network.models import NetworkRange, Network
 from insektavm.vpn.models import AssignedIPAddress
+from insektavm.vm.scheduler import has_free_memory, select_node
 from insektavm.vpn.signals import ip_assigned, ip_unassigned
 
-CHUNK_SIZE = 8096
+_storage_pools = {}
+_backing_volumes = {}
+_cache_lock = threading.Lock()
+
+CHUNK_SIZE = 4 * 1024 * 1024
+ZERO_CHUNK = bytes(CHUNK_SIZE)
 STORAGE_POOL_NAME = settings.LIBVIRT_PREFIX + 'insekta'
+DOMAIN_NAME_RE = re.compile('^{}insekta_vm_([0-9]+)$'.format(re.escape(settings.LIBVIRT_PREFIX)))
+
+VM_STATE_CHOICES = (
+    ('pending', 'Pending'),
+    ('booting', 'Booting'),
+    ('running', 'Running'),
+    ('paused', 'Paused'),
+    ('stopped', 'Stopped'),
+    ('crashed', 'Crashed'),
+    ('failed', 'Failed'),
+)
+
+# States in which the VM is usable or will be soon
+VM_HEALTHY_STATES = ('pending', 'booting', 'running')
+
+# How the VMs of a user are suspended while the user is not connected to the VPN
+SUSPEND_MODE_CHOICES = (
+    ('pause', 'Paused'),
+    ('managedsave', 'Saved to disk'),
+)
+
+DISK_CACHE_CHOICES = (
+    ('', 'Default'),
+    ('none', 'None'),
+    ('writeback', 'Writeback'),
+    ('unsafe', 'Unsafe'),
+)
+
+DISK_IO_CHOICES = (
+    ('', 'Default'),
+    ('native', 'Native'),
+    ('threads', 'Threads'),
+    ('io_uring', 'io_uring'),
+)
+
+MEMBALLOON_CHOICES = (
+    ('', 'Default'),
+    ('none', 'None'),
+    ('free_page_reporting', 'Free page reporting'),
+)
+
+BOOT_MODE_CHOICES = (
+    ('cold', 'Cold boot'),
+    ('snapshot', 'Restore from snapshot'),
+)
+
+JOB_ACTION_CHOICES = (
+    ('start', 'Start'),
+    ('stop', 'Stop'),
+    ('suspend', 'Suspend'),
+    ('resume', 'Resume'),
+)
+
+JOB_STATE_CHOICES = (
+    ('waiting', 'Waiting for capacity'),
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
 
 
 class VMTemplate(models.Model):
@@ -24,72 +101,177 @@ class VMTemplate(models.Model):
     name = models.CharField(max_length=40)
     memory = models.IntegerField()
     boot_type = models.CharField(max_length=8, default='efi', choices=(('efi', 'EFI boot'), ('mbr', 'MBR boot')))
+    boot_mode = models.CharField(max_length=8, default='cold', choices=BOOT_MODE_CHOICES)
     image_fingerprint = models.CharField(max_length=64)
+    image_name = models.CharField(max_length=255, blank=True)
     order_id = models.IntegerField()
 
+    # Performance profile of the domain
+    vcpus = models.PositiveSmallIntegerField(default=1)
+    cpuset = models.CharField(max_length=100, blank=True,
+                              help_text='Host CPUs the vCPUs are pinned to, e.g. 2-7,^4')
+    iothreads = models.PositiveSmallIntegerField(default=0,
+                                                 help_text='0 runs disk IO in the main loop')
+    disk_cache = models.CharField(max_length=10, blank=True, choices=DISK_CACHE_CHOICES)
+    disk_io = models.CharField(max_length=10, blank=True, choices=DISK_IO_CHOICES,
+                               help_text='Native requires the disk cache to be none')
+    net_queues = models.PositiveSmallIntegerField(default=1,
+                                                  help_text='Queues of the virtio NIC')
+    hugepages = models.BooleanField(default=False)
+    memballoon = models.CharField(max_length=20, blank=True, choices=MEMBALLOON_CHOICES)
+    graphics = models.BooleanField(default=True, help_text='VNC console')
+
     def __str__(self):
         return '{} ({})'.format(self.name, self.resource)
 
+    def clean(self):
+        if self.disk_io == 'native' and self.disk_cache != 'none':
+            raise ValidationError({'disk_io': 'Native IO requires the disk cache to be none.'})
+
+    def get_profile_hash(self):
+        # Snapshots can only be restored with the virtual hardware they were captured with
+        profile = dict(self.get_domain_options(), memory=self.memory, boot_type=self.boot_type,
+                       image=self.get_image_filename())
+        return hashlib.sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+    def get_domain_options(self):
+        # Keyword arguments for libvirtxml.domain_xml()
+        return {
+            'vcpus': self.vcpus,
+            'cpuset': self.cpuset,
+            'iothreads': self.iothreads,
+            'disk_cache': self.disk_cache,
+            'disk_io': self.disk_io,
+            'net_queues': self.net_queues,
+            'hugepages': self.hugepages,
+            'memballoon': self.memballoon,
+            'graphics': self.graphics,
+        }
+
     def get_image_filename(self):
-        resource_name = re.sub(r'[^\w_]', '', self.resource.name.strip().lower())
-        resource_name = re.sub(r'[\s-]+', '_', resource_name)
+        if self.image_name:
+            return self.image_name
+        # Images imported before image_name existed are named after their fingerprint
         return '{}backing-{}-{}.qcow2'.format(settings.LIBVIRT_PREFIX,
-                                              resource_name,
+                                              self._get_resource_slug(),
                                               self.image_fingerprint)
 
+    def _get_resource_slug(self):
+        resource_name = re.sub(r'[^\w_]', '', self.resource.name.strip().lower())
+        return re.sub(r'[\s-]+', '_', resource_name)
+
     def delete_image(self):
-        virtconn = connections['default']
-        pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
-        try:
-            volume = pool.storageVolLookupByName(self.get_image_filename())
-            volume.undefine()
-        except libvirt.libvirtError:
+        # Snapshots use the image as backing volume
+        for snapshot in self.vmsnapshot_set.all():
+            snapshot.delete_volumes()
+            snapshot.delete()
+        if self._is_image_shared():
             return
+        for node in settings.LIBVIRT_NODES:
+            _forget_backing_volume(node, self.get_image_filename())
+            virtconn = connections[node]
+            pool = get_storage_pool(virtconn)
+            try:
+                volume = pool.storageVolLookupByName(self.get_image_filename())
+                volume.delete()
+            except libvirt.libvirtError:
+                continue
 
-    @classmethod
-    def from_image(cls, resource, name, memory, boot_type, order_id, image_filename):
-        file_size = 0
-        h = hashlib.sha256()
-        with open(image_filename, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if not data:
-                    break
-                file_size += len(data)
-                h.update(data)
-        image_fingerprint = h.hexdigest()
+    def _is_image_shared(self):
+        # Templates imported from the same image use the same volumes
+        image_filename = self.get_image_filename()
+        others = (VMTemplate.objects.filter(image_fingerprint=self.image_fingerprint)
+                  .exclude(pk=self.pk)
+                  .select_related('resource'))
+        return any(other.get_image_filename() == image_filename for other in others
+                   if other.image_name or other.resource is not None)
 
+    @classmethod
+    def from_image(cls, resource, name, memory, boot_type, order_id, image_filename,
+                   progress=None, boot_mode='cold'):
+        file_size = os.path.getsize(image_filename)
         vm_template = cls(resource=resource,
                           name=name,
                           memory=memory,
                           boot_type=boot_type,
-                          image_fingerprint=image_fingerprint,
+                          boot_mode=boot_mode,
                           order_id=order_id)
+        # The fingerprint is only known after the upload, so the volume gets a unique name
+        vm_template.image_name = '{}backing-{}-{}.qcow2'.format(settings.LIBVIRT_PREFIX,
+                                                                vm_template._get_resource_slug(),
+                                                                uuid.uuid4().hex)
         vm_template.save()
-        volume_name = vm_template.get_image_filename()
+        volume_xml = libvirtxml.backing_volume_xml(vm_template.image_name, file_size)
 
-        virtconn = connections['default']
-        pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
-        volume_xml = render_to_string('vm/backing_volume.xml', {
-            'name': volume_name,
-            'capacity': file_size
-        })
+        # Every node needs the image, since VMs can be placed on any of them.
+        # The file is read once, hashed and sent to all nodes at the same time.
+        uploads = []
         try:
-            volume = pool.createXML(volume_xml)
-        except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_STORAGE_VOL_EXIST:
-                return vm_template
+            for node in settings.LIBVIRT_NODES:
+                virtconn = connections[node]
+                pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
+                volume = pool.createXML(volume_xml)
+                stream = virtconn.newStream()
+                uploads.append((volume, stream))
+                volume.upload(stream, 0, file_size, libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+
+            h = hashlib.sha256()
+            bytes_done = 0
+            with open(image_filename, 'rb') as f:
+                for is_data, offset, length in _iter_image_segments(f, file_size):
+                    f.seek(offset)
+                    while length > 0:
+                        chunk_size = min(length, CHUNK_SIZE)
+                        data = f.read(chunk_size) if is_data else None
+                        # Zero blocks are sent as holes as well, not only the ones of sparse files
+                        if data is None or data == ZERO_CHUNK[:chunk_size]:
+                            h.update(ZERO_CHUNK[:chunk_size])
+                            for volume, stream in uploads:
+                                stream.sendHole(chunk_size)
+                        else:
+                            h.update(data)
+                            for volume, stream in uploads:
+                                _stream_send_all(stream, data)
+                        length -= chunk_size
+                        bytes_done += chunk_size
+                        if progress is not None:
+                            progress(bytes_done, file_size)
+
+            for volume, stream in uploads:
+                stream.finish()
+                # Verify that the pool received the whole image
+                physical_size = volume.infoFlags(libvirt.VIR_STORAGE_VOL_GET_PHYSICAL)[2]
+                if physical_size != file_size:
+                    raise VirtError('Uploaded image has {} bytes instead of {}'.format(
+                        physical_size, file_size))
+        except Exception:
+            for volume, stream in uploads:
+                try:
+                    stream.abort()
+                except libvirt.libvirtError:
+                    pass
+                try:
+                    volume.delete()
+                except libvirt.libvirtError:
+                    pass
+            vm_template.delete()
             raise
-        stream = virtconn.newStream()
-        volume.upload(stream, offset=0, length=file_size)
-        with open(image_filename, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if not data:
-                    stream.finish()
-                    break
-                stream.send(data)
 
+        vm_template.image_fingerprint = h.hexdigest()
+        # The same image was imported before, its volumes are used instead of the new ones
+        existing = (cls.objects.filter(image_fingerprint=vm_template.image_fingerprint,
+                                       resource__isnull=False)
+                    .exclude(pk=vm_template.pk)
+                    .select_related('resource')
+                    .first())
+        if existing is not None:
+            for volume, stream in uploads:
+                try:
+                    volume.delete()
+                except libvirt.libvirtError:
+                    pass
+            vm_template.image_name = existing.get_image_filename()
+        vm_template.save()
         return vm_template
 
     @classmethod
@@ -106,64 +288,229 @@ class VMTemplate(models.Model):
         return num_deleted
 
 
+class VMSnapshot(models.Model):
+    # A booted VM of a template saved with its memory, VMs restored from it are
+    # usable right away. Restored VMs keep the UUID of the snapshot, so a snapshot
+    # is used by one VM at a time and each node has VM_SNAPSHOT_COPIES of them.
+    template = models.ForeignKey(VMTemplate, on_delete=models.CASCADE)
+    node = models.CharField(max_length=40)
+    index = models.PositiveIntegerField()
+    uuid = models.UUIDField(default=uuid.uuid4)
+    # Of the template when the snapshot was captured
+    profile_hash = models.CharField(max_length=64, blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('template', 'node', 'index')
+
+    def __str__(self):
+        return '{} on {} ({})'.format(self.template, self.node, self.index)
+
+    def get_name(self):
+        return '{}insekta_snapshot_{}_{}'.format(settings.LIBVIRT_PREFIX, self.template_id,
+                                                 self.index)
+
+    def get_disk_volume_name(self):
+        return self.get_name() + '.qcow2'
+
+    def get_memory_volume_name(self):
+        return self.get_name() + '.save'
+
+    def delete_volumes(self):
+        _forget_backing_volume(self.node, self.get_disk_volume_name())
+        pool = get_storage_pool(connections[self.node])
+        for volume_name in (self.get_disk_volume_name(), self.get_memory_volume_name()):
+            try:
+                pool.storageVolLookupByName(volume_name).delete()
+            except libvirt.libvirtError:
+                continue
+
+    @classmethod
+    def capture(cls, template, node, index, boot_time):
+        # Boots the template without a NIC, so the saved memory has no MAC or
+        # network in it, and saves it once the guest had boot_time seconds to boot
+        snapshot = cls(template=template, node=node, index=index,
+                       profile_hash=template.get_profile_hash())
+        virtconn = connections[node]
+        pool = get_storage_pool(virtconn)
+        backing_image_path, backing_size = get_backing_volume(node, pool,
+                                                              template.get_image_filename())
+        disk_volume = pool.createXML(libvirtxml.volume_xml(snapshot.get_disk_volume_name(),
+                                                           backing_size, backing_image_path))
+        memory_volume = pool.createXML(libvirtxml.raw_volume_xml(
+            snapshot.get_memory_volume_name(), 0))
+        domain_xml = libvirtxml.domain_xml(name=snapshot.get_name(),
+                                           volume=disk_volume.path(),
+                                           memory=template.memory,
+                                           boot_type=template.boot_type,
+                                           network=None,
+                                           mac=None,
+                                           nwfilter_name=None,
+                                           domain_type=getattr(settings, 'LIBVIRT_DOMAIN_TYPE',
+                                                               'kvm'),
+                                           uuid=str(snapshot.uuid),
+                                           **template.get_domain_options())
+        try:
+            dom = virtconn.createXML(domain_xml)
+            try:
+                time.sleep(boot_time)
+                # Stops the domain, the disk must not change afterwards
+                dom.save(memory_volume.path())
+            except libvirt.libvirtError:
+                dom.destroy()
+                raise
+        except libvirt.libvirtError:
+            disk_volume.delete()
+            memory_volume.delete()
+            raise
+        snapshot.save()
+        return snapshot
+
+    @classmethod
+    def claim(cls, vm):
+        # Returns None if all snapshots of the template on the node are in use.
+        # Snapshots captured before the template was edited are left alone.
+        while True:
+            snapshot = (cls.objects.filter(template=vm.template, node=vm.vm_resource.node,
+                                           profile_hash=vm.template.get_profile_hash(),
+                                           virtualmachine__isnull=True)
+                        .order_by('index')
+                        .first())
+            if snapshot is None:
+                return None
+            try:
+                with transaction.atomic():
+                    VirtualMachine.objects.filter(pk=vm.pk).update(snapshot=snapshot)
+            except IntegrityError:
+                # Another VM was faster
+                continue
+            vm.snapshot = snapshot
+            return snapshot
+
+
+class NodeLock(models.Model):
+    # A row per node, locked from checking the free memory of the node until the
+    # VM rows reserving it are committed. Admission is serialized by the database,
+    # so concurrent starts on all hosts see the memory reserved by each other.
+    node = models.CharField(max_length=40, unique=True)
+
+    def __str__(self):
+        return self.node
+
+    @classmethod
+    @contextmanager
+    def lock(cls, nodes):
+        nodes = sorted(nodes)
+        with transaction.atomic():
+            # Always locked in the same order, so admissions don't deadlock
+            locks = cls.objects.select_for_update().filter(node__in=nodes).order_by('node')
+            if len(locks) < len(nodes):
+                cls.objects.bulk_create([cls(node=node) for node in nodes], ignore_conflicts=True)
+                list(locks.all())
+            yield
+
+
 class ActiveVMResource(models.Model):
     resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
-    user_token = models.ForeignKey(UserToken, on_delete=models.CASCADE)
+    # Instances without a user token are pre-started and wait in the pool of their resource
+    user_token = models.ForeignKey(UserToken, on_delete=models.CASCADE, blank=True, null=True)
     network = models.ForeignKey(Network, on_delete=models.CASCADE)
+    node = models.CharField(max_length=40, default='default')
     expire_time = models.DateTimeField()
     is_started = models.BooleanField(default=False)
+    suspended = models.CharField(max_length=12, blank=True, choices=SUSPEND_MODE_CHOICES)
 
     class Meta:
         unique_together = ('resource', 'user_token')
+        indexes = [
+            # destroy_expired() only looks at instances that belong to a user
+            models.Index(fields=['expire_time'], condition=models.Q(user_token__isnull=False),
+                         name='vm_res_expire_time_idx'),
+            models.Index(fields=['user_token', 'is_started'], name='vm_res_user_started_idx'),
+        ]
 
     def __str__(self):
+        if self.user_token is None:
+            return '{} (pooled)'.format(self.resource)
         return '{} for {}'.format(self.resource, self.user_token)
 
     def start(self):
-        # Make sure just one process is starting this VM
-        if self.pk:
-            with transaction.atomic():
-                vm_res = ActiveVMResource.objects.select_for_update().get(pk=self.pk)
-                # Some other process was faster
-                if vm_res.is_started:
-                    return
-                vm_res.is_started = True
-                vm_res._ping()
-                vm_res.save()
+        vm_templates = list(VMTemplate.objects.filter(resource=self.resource)
+                            .select_related('resource')
+                            .order_by('order_id'))
+        memory = sum(vm_template.memory for vm_template in vm_templates)
+        with NodeLock.lock(settings.LIBVIRT_NODES):
+            # Admission control: raises CapacityError before anything is changed
+            node = select_node(memory, VirtualMachine.get_committed_memory())
 
-        self._ping()
-        self.is_started = True
+            # Make sure just one process is starting this VM
+            if self.pk:
+                with transaction.atomic():
+                    vm_res = ActiveVMResource.objects.select_for_update().get(pk=self.pk)
+                    # Some other process was faster
+                    if vm_res.is_started:
+                        return
+                    vm_res.is_started = True
+                    vm_res._ping()
+                    vm_res.save()
 
-        self.network = NetworkRange.objects.get(name='default').get_free_network()
+            self._ping()
+            self.is_started = True
+            self.node = node
+            self.network = NetworkRange.allocate_network(self.node)
 
-        # We save it now because:
-        # 1) we don't want to loose information if something with libvirt fails
-        # 2) we want to make sure the object is in the database so others can relate to it.
-        self.save()
+            # We save it now because:
+            # 1) we don't want to loose information if something with libvirt fails
+            # 2) we want to make sure the object is in the database so others can relate to it.
+            self.save()
+            # Create all rows first, so they reserve the memory of the VMs for the next
+            # start, the status API can report the progress of each VM and _stop() can
+            # clean up all of them if something fails
+            vms = VirtualMachine.objects.bulk_create([
+                VirtualMachine(vm_resource=self,
+                               template=vm_template,
+                               backing_image=vm_template.image_fingerprint,
+                               state='booting')
+                for vm_template in vm_templates])
 
         # If the libvirt connection is down initially, delete the resource and re-raise
         # If it fails midway, keep the resource for safe cleanup
         try:
             self.network.libvirt_create()
         except VirtError:
-            self.network.in_use = False
-            self.network.save()
+            self.network.release()
             self.delete()
             raise
         macs = self.network.get_macs()
-        vm_templates = VMTemplate.objects.filter(resource=self.resource).order_by('order_id')
-        for vm_template, mac in zip(vm_templates, macs):
-            vm = VirtualMachine(vm_resource=self,
-                                template=vm_template,
-                                backing_image=vm_template.image_fingerprint)
-            vm.save()
-            vm.libvirt_create(self.network, mac)
+        for vm in vms:
+            if vm.template.boot_mode == 'snapshot':
+                VMSnapshot.claim(vm)
+        executor = connections.get_executor(self.node)
+        # The context carries the current trace over to the executor threads
+        futures = {executor.submit(contextvars.copy_context().run,
+                                   vm.libvirt_create, self.network, mac): vm
+                   for vm, mac in zip(vms, macs)}
+        error = None
+        for future in as_completed(futures):
+            vm = futures[future]
+            try:
+                snapshot_failed = future.result()
+            except Exception as e:
+                vm.set_state('failed')
+                if error is None:
+                    error = e
+            else:
+                if snapshot_failed:
+                    # Free for the next VM, the snapshot might restore on another try
+                    vm.snapshot = None
+                    vm.state = 'running'
+                    VirtualMachine.objects.filter(pk=vm.pk).update(state='running', snapshot=None)
+                else:
+                    vm.set_state('running')
+        if error is not None:
+            raise error
 
-        try:
-            ip = AssignedIPAddress.objects.get(user_token=self.user_token).ip_address
-            self.network.grant_access(ip)
-        except AssignedIPAddress.DoesNotExist:
-            pass
+        self._grant_vpn_access()
 
     def stop(self):
         self._stop()
@@ -175,58 +522,207 @@ class ActiveVMResource(models.Model):
         self.delete()
 
     def ping(self):
-        if self.is_started:
-            virtconn = connections["default"]
+        if self.suspended:
+            # Resumed when the user connects to the VPN again
+            pass
+        elif self.is_started and getattr(settings, 'VM_STATE_FROM_EVENTS', False):
+            # The states are kept up to date by the watch_vm_events command
+            vm = (VirtualMachine.objects.filter(vm_resource=self)
+                  .exclude(state__in=VM_HEALTHY_STATES)
+                  .first())
+            if vm is not None:
+                raise VirtError('VM {} is {}'.format(vm.get_domain_name(), vm.state))
+        elif self.is_started:
+            virtconn = connections[self.node]
             for vm in VirtualMachine.objects.filter(vm_resource=self):
                 try:
                     dom = virtconn.lookupByName(vm.get_domain_name())
                     if not dom.isActive():
                         raise VirtError('VM {} is not running'.format(vm.get_domain_name()))
                 except libvirt.libvirtError:
-                    connections.invalidate('default')
+                    connections.invalidate(self.node)
                     raise VirtError("Could not reach KVM host")
         self._ping()
-        self.save()
+        self.save(update_fields=['expire_time'])
         return self.expire_time
 
+    def suspend(self, mode):
+        # Paused VMs keep their memory, saved ones give it back to the node
+        if not self.is_started or self.suspended:
+            return
+        self._for_each_domain(lambda dom: dom.suspend() if mode == 'pause' else dom.managedSave())
+        VirtualMachine.objects.filter(vm_resource=self).update(
+            state='paused' if mode == 'pause' else 'stopped')
+        self.suspended = mode
+        self.save(update_fields=['suspended'])
+
+    def resume(self):
+        if not self.suspended:
+            return
+        mode = self.suspended
+        if mode == 'managedsave':
+            memory = (VirtualMachine.objects.filter(vm_resource=self)
+                      .aggregate(memory=models.Sum('template__memory')))['memory'] or 0
+            with NodeLock.lock([self.node]):
+                if not has_free_memory(self.node, memory, VirtualMachine.get_committed_memory()):
+                    raise CapacityError('Node {} has no {} MiB of free memory'.format(
+                        self.node, memory))
+                # Saved VMs count as committed memory again
+                self.suspended = ''
+                self.save(update_fields=['suspended'])
+        # Starting a domain with a managed save image restores it
+        self._for_each_domain(lambda dom: dom.resume() if mode == 'pause' else dom.create())
+        VirtualMachine.objects.filter(vm_resource=self).update(state='running')
+        self.suspended = ''
+        self._ping()
+        self.save(update_fields=['suspended', 'expire_time'])
+
+    def _for_each_domain(self, func):
+        virtconn = connections[self.node]
+        executor = connections.get_executor(self.node)
+
+        def run(domain_name):
+            try:
+                func(virtconn.lookupByName(domain_name))
+            except libvirt.libvirtError:
+                # Broken VMs are reported by ping() once the resource is resumed
+                pass
+
+        # Saving writes the memory of the VM to disk, so all VMs are handled at once
+        futures = [executor.submit(contextvars.copy_context().run, run, vm.get_domain_name())
+                   for vm in self.virtualmachine_set.all()]
+        for future in futures:
+            future.result()
+
     def _stop(self):
         if not self.is_started:
             raise ValueError('VM Resource is not started yet.')
-        vms = VirtualMachine.objects.filter(vm_resource=self)
+        # The related manager sets vm.vm_resource, so no query per VM is needed for the node
+        vms = self.virtualmachine_set.all()
         for vm in vms:
             vm.libvirt_destroy()
-            vm.delete()
+        vms.delete()
         self.network.free()
 
     def _ping(self):
         self.expire_time = now() + timedelta(minutes=30)
 
+    def _grant_vpn_access(self):
+        if self.user_token is None:
+            return
+        try:
+            ip = AssignedIPAddress.objects.get(user_token=self.user_token).ip_address
+            self.network.grant_access(ip)
+        except AssignedIPAddress.DoesNotExist:
+            pass
+
     def get_vms(self):
-        vm_objs = (VirtualMachine.objects.filter(vm_resource=self)
-                   .select_related('template')
-                   .order_by('template__order_id'))
+        # Batch lookups prefetch the VMs of many resources with get_vms_prefetch()
+        vm_objs = getattr(self, 'prefetched_vms', None)
+        if vm_objs is None:
+            vm_objs = (VirtualMachine.objects.filter(vm_resource=self)
+                       .select_related('template')
+                       .order_by('template__order_id'))
         vms = {}
-        for vm_obj, ip in zip(vm_objs, self.network.get_vm_ips()):
+        for i, vm_obj in enumerate(vm_objs):
             vms[vm_obj.template.name] = {
-                'ip': str(ip)
+                'ip': str(self.network.get_vm_ip(i)),
+                'state': vm_obj.state
             }
         return vms
 
+    @staticmethod
+    def get_vms_prefetch():
+        return models.Prefetch('virtualmachine_set',
+                               queryset=(VirtualMachine.objects.select_related('template')
+                                         .order_by('template__order_id')),
+                               to_attr='prefetched_vms')
+
     @classmethod
-    def start_for(cls, resource, user_token):
+    def start_for(cls, resource, user_token, admitted=False):
+        # Raises CapacityError if the start has to wait for free memory. Unless the
+        # start was admitted from the queue, it has to wait behind the queued ones.
         try:
-            vm_res = cls.objects.get(resource=resource, user_token=user_token)
+            vm_res = (cls.objects.select_related('network')
+                      .get(resource=resource, user_token=user_token))
         except cls.DoesNotExist:
+            vm_res = cls.claim_pooled(resource, user_token)
+            if vm_res is not None:
+                return vm_res
             vm_res = cls(resource=resource, user_token=user_token)
+        if vm_res.is_started:
+            if vm_res.suspended:
+                vm_res.resume()
+            return vm_res
+        if not admitted and VMJob.objects.filter(state='waiting').exists():
+            raise CapacityError('Other starts are waiting for free memory')
         vm_res.start()
         return vm_res
 
+    @classmethod
+    def claim_pooled(cls, resource, user_token):
+        # Returns None if there is no pre-started instance of the resource left.
+        # Instances with VMs that failed or are not up yet are never handed out.
+        not_running = VirtualMachine.objects.filter(vm_resource=models.OuterRef('pk')).exclude(
+            state='running')
+        try:
+            with transaction.atomic():
+                vm_res = (cls.objects.select_for_update(skip_locked=True)
+                          .filter(resource=resource, user_token__isnull=True, is_started=True)
+                          .exclude(models.Exists(not_running))
+                          .select_related('network')
+                          .order_by('pk')
+                          .first())
+                if vm_res is None:
+                    return None
+                vm_res.user_token = user_token
+                vm_res._ping()
+                vm_res.save()
+        except IntegrityError:
+            # Another request of the same user was faster
+            return cls.objects.get(resource=resource, user_token=user_token)
+        vm_res._grant_vpn_access()
+        return vm_res
+
+    @classmethod
+    def fill_pools(cls):
+        num_started = 0
+        # Starts of users waiting for free memory come first
+        starts_waiting = VMJob.objects.filter(state='waiting').exists()
+        for resource in Resource.objects.filter(type='vmnet'):
+            pooled = cls.objects.filter(resource=resource, user_token__isnull=True)
+            num_pooled = pooled.count()
+            # Shrink the pool if its size was lowered
+            for vm_res in pooled.order_by('-pk')[:max(num_pooled - resource.pool_size, 0)]:
+                vm_res.destroy()
+            if starts_waiting:
+                continue
+            for i in range(resource.pool_size - num_pooled):
+                vm_res = cls(resource=resource, user_token=None)
+                try:
+                    vm_res.start()
+                except (VirtError, libvirt.libvirtError):
+                    # A half-started instance would block the pool, start() only
+                    # cleans up if the network could not be created
+                    if vm_res.pk is not None:
+                        try:
+                            vm_res.destroy()
+                        except (VirtError, libvirt.libvirtError):
+                            pass
+                    # Try again on the next run, maybe the host is just busy
+                    break
+                num_started += 1
+        return num_started
+
     @classmethod
     def destroy_expired(cls):
         num_destroyed = 0
-        for vm_res in cls.objects.filter(expire_time__lt=now()):
+        expired = (cls.objects.filter(expire_time__lt=now(), user_token__isnull=False)
+                   .select_related('network'))
+        for vm_res in expired:
             vm_res.destroy()
             num_destroyed += 1
+        VMJob.admit_waiting()
         return num_destroyed
 
 
@@ -234,44 +730,92 @@ class VirtualMachine(models.Model):
     vm_resource = models.ForeignKey(ActiveVMResource, on_delete=models.CASCADE)
     template = models.ForeignKey(VMTemplate, on_delete=models.CASCADE)
     backing_image = models.CharField(max_length=64)
-
+    state = models.CharField(max_length=8, default='pending', choices=VM_STATE_CHOICES)
+    snapshot = models.OneToOneField(VMSnapshot, on_delete=models.SET_NULL, blank=True,
+                                    null=True)
 
     def __str__(self):
         return str(self.pk)
 
+    def set_state(self, state):
+        self.state = state
+        VirtualMachine.objects.filter(pk=self.pk).update(state=state)
+
     def libvirt_create(self, network, mac):
-        virtconn = connections['default']
-        pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
-        backing_image_filename = self.template.get_image_filename()
-        backing_vol = pool.storageVolLookupByName(backing_image_filename)
-        backing_image_path = backing_vol.path()
-        backing_size = backing_vol.info()[1]
-
-        volume_xml = render_to_string('vm/volume.xml', {
-            'name': self.get_volume_name(),
-            'capacity': backing_size,
-            'backing_image': backing_image_path
-        })
-        image = pool.createXML(volume_xml)
-        image_filename = image.path()
+        # Returns True if the claimed snapshot could not be restored and the VM
+        # was booted instead. Runs in executor threads, so it must not query the
+        # database; the snapshot is claimed by ActiveVMResource.start() beforehand.
+        node = self.vm_resource.node
+        virtconn = connections[node]
+        pool = get_storage_pool(virtconn)
         vm_tpl = self.template
-        network_name = network.libvirt_get_name()
-        nwfilter_name = network.libvirt_get_nwfilter_name()
-        domain_xml =  render_to_string('vm/domain.xml', {
-            'name': self.get_domain_name(),
-            'volume': image_filename,
-            'memory': vm_tpl.memory,
-            'boot_type': vm_tpl.boot_type,
-            'network': network_name,
-            'mac': mac,
-            'nwfilter_name': nwfilter_name
-        })
+        if getattr(settings, 'LIBVIRT_NWFILTERS', True):
+            nwfilter_name = network.libvirt_get_nwfilter_name()
+        else:
+            nwfilter_name = None
+        domain_type = getattr(settings, 'LIBVIRT_DOMAIN_TYPE', 'kvm')
+        if self.snapshot is not None:
+            try:
+                self._libvirt_restore(virtconn, pool, network, mac, nwfilter_name, domain_type)
+                return False
+            except libvirt.libvirtError:
+                # E.g. the CPU of the node changed since the snapshot was captured,
+                # remove the restored VM and boot it instead
+                self.libvirt_destroy()
+                try:
+                    pool.storageVolLookupByName(self.get_volume_name()).delete()
+                except libvirt.libvirtError:
+                    pass
+
+        backing_image_path, backing_size = get_backing_volume(node, pool,
+                                                              vm_tpl.get_image_filename())
+        volume_xml = libvirtxml.volume_xml(self.get_volume_name(), backing_size,
+                                           backing_image_path)
+        image = pool.createXML(volume_xml)
+        domain_xml = libvirtxml.domain_xml(name=self.get_domain_name(),
+                                           volume=image.path(),
+                                           memory=vm_tpl.memory,
+                                           boot_type=vm_tpl.boot_type,
+                                           network=network.libvirt_get_name(),
+                                           mac=mac,
+                                           nwfilter_name=nwfilter_name,
+                                           domain_type=domain_type,
+                                           **vm_tpl.get_domain_options())
         dom = virtconn.defineXML(domain_xml)
         dom.setAutostart(1)
         dom.create()
+        return self.snapshot is not None
+
+    def _libvirt_restore(self, virtconn, pool, network, mac, nwfilter_name, domain_type):
+        vm_tpl = self.template
+        snapshot = self.snapshot
+        backing_image_path, backing_size = get_backing_volume(self.vm_resource.node, pool,
+                                                              snapshot.get_disk_volume_name())
+        volume_xml = libvirtxml.volume_xml(self.get_volume_name(), backing_size,
+                                           backing_image_path)
+        image = pool.createXML(volume_xml)
+        # Only the name and the disk may differ from the saved domain. The NIC is
+        # plugged in after the restore, the guest picks up its address by DHCP.
+        domain_xml = libvirtxml.domain_xml(name=self.get_domain_name(),
+                                           volume=image.path(),
+                                           memory=vm_tpl.memory,
+                                           boot_type=vm_tpl.boot_type,
+                                           network=None,
+                                           mac=None,
+                                           nwfilter_name=None,
+                                           domain_type=domain_type,
+                                           uuid=str(snapshot.uuid),
+                                           **vm_tpl.get_domain_options())
+        dom = virtconn.defineXML(domain_xml)
+        dom.setAutostart(1)
+        memory_volume = pool.storageVolLookupByName(snapshot.get_memory_volume_name())
+        virtconn.restoreFlags(memory_volume.path(), domain_xml, libvirt.VIR_DOMAIN_SAVE_RUNNING)
+        dom.attachDeviceFlags(libvirtxml.interface_xml(network.libvirt_get_name(), mac,
+                                                       nwfilter_name, vm_tpl.net_queues),
+                              libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
 
     def libvirt_destroy(self):
-        virtconn = connections['default']
+        virtconn = connections[self.vm_resource.node]
         try:
             dom = virtconn.lookupByName(self.get_domain_name())
         except libvirt.libvirtError as e:
@@ -282,8 +826,9 @@ class VirtualMachine(models.Model):
         except libvirt.libvirtError as e:
             # FIXME: Check error code
             pass
-        dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
-        pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
+        dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM |
+                          libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE)
+        pool = get_storage_pool(virtconn)
         try:
             vol = pool.storageVolLookupByName(self.get_volume_name())
         except libvirt.libvirtError:
@@ -291,6 +836,36 @@ class VirtualMachine(models.Model):
             return
         vol.delete()
 
+    @classmethod
+    def get_committed_memory(cls):
+        # Saved VMs don't use memory until they are resumed
+        committed = (cls.objects.exclude(vm_resource__suspended='managedsave')
+                     .values('vm_resource__node')
+                     .annotate(memory=models.Sum('template__memory')))
+        return {row['vm_resource__node']: row['memory'] for row in committed}
+
+    @classmethod
+    def sync_states(cls, node, states):
+        # states maps primary keys to the states of all domains on the node. VMs
+        # still being created are left alone, their domain might not exist yet.
+        vms = (cls.objects.filter(vm_resource__node=node)
+               .exclude(state__in=('pending', 'booting', 'failed')))
+        pks_by_state = {}
+        for pk, state in vms.values_list('pk', 'state'):
+            new_state = states.get(pk, 'stopped')
+            if new_state != state:
+                pks_by_state.setdefault(new_state, []).append(pk)
+        for state, pks in pks_by_state.items():
+            cls.objects.filter(pk__in=pks).update(state=state)
+
+    @staticmethod
+    def get_pk_from_domain_name(domain_name):
+        # None for domains not managed by us
+        match = DOMAIN_NAME_RE.match(domain_name)
+        if match is None:
+            return None
+        return int(match.group(1))
+
     def get_domain_name(self):
         return '{}insekta_vm_{}'.format(settings.LIBVIRT_PREFIX, self.pk)
 
@@ -298,15 +873,294 @@ class VirtualMachine(models.Model):
         return '{}vmimage_{}.qcow2'.format(settings.LIBVIRT_PREFIX, self.pk)
 
 
+class VMJob(models.Model):
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
+    user_token = models.ForeignKey(UserToken, on_delete=models.CASCADE)
+    action = models.CharField(max_length=8, choices=JOB_ACTION_CHOICES)
+    state = models.CharField(max_length=8, default='queued', choices=JOB_STATE_CHOICES)
+    error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    finished_time = models.DateTimeField(blank=True, null=True)
+    # Updated while the job is running, jobs of dead workers stop getting updates
+    heartbeat_time = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(state='waiting'),
+                         name='vm_job_waiting_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {} for {} ({})'.format(self.action, self.resource, self.user_token, self.state)
+
+    def run(self, admitted=False):
+        with tracing.trace('vm_job {} {}'.format(self.action, self.pk)):
+            self._run(admitted)
+
+    def _run(self, admitted):
+        frees_memory = self.action == 'stop'
+        try:
+            if self.action == 'start':
+                ActiveVMResource.start_for(self.resource, self.user_token, admitted)
+            else:
+                vm_res = (ActiveVMResource.objects.filter(resource=self.resource,
+                                                          user_token=self.user_token)
+                          .select_related('network')
+                          .first())
+                if vm_res is None:
+                    pass
+                elif self.action == 'suspend':
+                    suspend_mode = getattr(settings, 'VM_SUSPEND_ON_VPN_DISCONNECT', None)
+                    if suspend_mode:
+                        vm_res.suspend(suspend_mode)
+                        # Saved VMs give their memory back to the node
+                        frees_memory = suspend_mode == 'managedsave'
+                elif self.action == 'resume':
+                    vm_res.resume()
+                else:
+                    vm_res.destroy()
+        except CapacityError as e:
+            # Keeps its place in the queue until admit_waiting() runs it
+            self.state = 'waiting'
+            self.error = str(e)
+            self.save()
+            return
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+        else:
+            self.state = 'done'
+            self.error = ''
+        self.finished_time = now()
+        self.save()
+        if frees_memory:
+            # The memory of the stopped or saved VMs might be enough for waiting starts
+            VMJob.admit_waiting()
+
+    def get_queue_position(self):
+        # 1 for the next start to be admitted
+        return VMJob.objects.filter(state='waiting', pk__lte=self.pk).count()
+
+    @classmethod
+    def get_pending(cls, resource, user_token):
+        return (cls.objects.filter(resource=resource, user_token=user_token,
+                                   state__in=('waiting', 'queued', 'running'))
+                .order_by('-pk')
+                .first())
+
+    @classmethod
+    def enqueue(cls, action, resource, user_token, state='queued'):
+        # Starting or stopping twice in a row does not make sense, reuse the pending job
+        job = cls.get_pending(resource, user_token)
+        if job is not None and job.action == action:
+            return job
+        return cls.objects.create(resource=resource, user_token=user_token, action=action,
+                                  state=state)
+
+    @classmethod
+    def cancel_waiting(cls, resource, user_token):
+        return (cls.objects.filter(resource=resource, user_token=user_token, state='waiting')
+                .update(state='failed', error='Cancelled', finished_time=now()))
+
+    @classmethod
+    def cancel_suspend(cls, user_token):
+        # Returns the primary keys of the resources with a suspend job that already runs
+        (cls.objects.filter(user_token=user_token, action='suspend', state='queued')
+         .update(state='failed', error='Cancelled', finished_time=now()))
+        return set(cls.objects.filter(user_token=user_token, action='suspend', state='running')
+                   .values_list('resource_id', flat=True))
+
+    @classmethod
+    def admit_waiting(cls):
+        # Starts the waiting jobs in FIFO order until the first one does not fit.
+        # Later ones are not tried, so large resources do not starve.
+        num_admitted = 0
+        while True:
+            job = (cls.objects.filter(state='waiting')
+                   .select_related('resource', 'user_token')
+                   .order_by('pk')
+                   .first())
+            if job is None:
+                break
+            # Another process might be admitting the same job
+            if not (cls.objects.filter(pk=job.pk, state='waiting')
+                    .update(state='running', heartbeat_time=now())):
+                continue
+            job.state = 'running'
+            job.run(admitted=True)
+            if job.state == 'waiting':
+                break
+            num_admitted += 1
+        return num_admitted
+
+    @classmethod
+    def claim_next(cls):
+        # Jobs of the same user and resource must run one after another
+        earlier_jobs = cls.objects.filter(resource=models.OuterRef('resource'),
+                                          user_token=models.OuterRef('user_token'),
+                                          state__in=('waiting', 'queued', 'running'),
+                                          pk__lt=models.OuterRef('pk'))
+        with transaction.atomic():
+            job = (cls.objects.select_for_update(skip_locked=True, of=('self',))
+                   .select_related('resource', 'user_token')
+                   .filter(state='queued')
+                   .exclude(models.Exists(earlier_jobs))
+                   .order_by('pk')
+                   .first())
+            if job is None:
+                return None
+            job.state = 'running'
+            job.heartbeat_time = now()
+            job.save()
+        return job
+
+    @classmethod
+    def heartbeat(cls, pks):
+        return cls.objects.filter(pk__in=pks, state='running').update(heartbeat_time=now())
+
+    @classmethod
+    def requeue_stale(cls):
+        # Jobs of workers that died midway
+        timeout = timedelta(seconds=getattr(settings, 'VM_JOB_TIMEOUT', 600))
+        return (cls.objects.filter(models.Q(heartbeat_time__lt=now() - timeout) |
+                                   models.Q(heartbeat_time__isnull=True), state='running')
+                .update(state='queued'))
+
+    @classmethod
+    def prune(cls):
+        retention = timedelta(days=getattr(settings, 'VM_JOB_RETENTION_DAYS', 7))
+        num_deleted, _ = cls.objects.filter(state__in=('done', 'failed'),
+                                            finished_time__lt=now() - retention).delete()
+        return num_deleted
+
+
+def get_storage_pool(virtconn):
+    # Pool handles belong to a connection and connections are per thread,
+    # so the handles are cached per connection
+    with _cache_lock:
+        pool = _storage_pools.get(virtconn)
+    if pool is None:
+        pool = virtconn.storagePoolLookupByName(STORAGE_POOL_NAME)
+        with _cache_lock:
+            _storage_pools[virtconn] = pool
+    return pool
+
+
+def get_backing_volume(node, pool, image_filename):
+    # Template images never change, so their path and capacity can be cached
+    key = (node, image_filename)
+    with _cache_lock:
+        backing_volume = _backing_volumes.get(key)
+    if backing_volume is None:
+        backing_vol = pool.storageVolLookupByName(image_filename)
+        backing_volume = (backing_vol.path(), backing_vol.info()[1])
+        with _cache_lock:
+            _backing_volumes[key] = backing_volume
+    return backing_volume
+
+
+def _forget_backing_volume(node, image_filename):
+    with _cache_lock:
+        _backing_volumes.pop((node, image_filename), None)
+
+
+def _callback_connection_invalidated(sender, node, connection, **kwargs):
+    with _cache_lock:
+        _storage_pools.pop(connection, None)
+        for key in list(_backing_volumes):
+            if key[0] == node:
+                del _backing_volumes[key]
+
+
+def _iter_image_segments(f, file_size):
+    # Yields (is_data, offset, length) for the data and holes of a sparse file
+    offset = 0
+    while offset < file_size:
+        try:
+            data_offset = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                # Hole detection is not supported by the file system
+                yield True, offset, file_size - offset
+                return
+            # Only a hole is left until the end of the file
+            data_offset = file_size
+        if data_offset > offset:
+            yield False, offset, data_offset - offset
+        if data_offset >= file_size:
+            return
+        hole_offset = os.lseek(f.fileno(), data_offset, os.SEEK_HOLE)
+        yield True, data_offset, hole_offset - data_offset
+        offset = hole_offset
+
+
+def _stream_send_all(stream, data):
+    while data:
+        num_sent = stream.send(data)
+        data = data[num_sent:]
+
+
 def _callback_ip_assigned(sender, user_token, ip_address, **kwargs):
-    for vm_res in ActiveVMResource.objects.filter(user_token=user_token, is_started=True):
-        vm_res.network.grant_access(ip_address)
+    # The VPN waits for this, so suspending and resuming is left to run_vm_jobs
+    vm_resources = (ActiveVMResource.objects.filter(user_token=user_token, is_started=True)
+                    .select_related('network', 'resource'))
+    suspending = VMJob.cancel_suspend(user_token)
+    for vm_res in vm_resources:
+        try:
+            vm_res.network.grant_access(ip_address)
+        except (VirtError, libvirt.libvirtError):
+            # The other resources of the user should still be reachable
+            pass
+        if vm_res.suspended or vm_res.resource_id in suspending:
+            VMJob.enqueue('resume', vm_res.resource, user_token)
 
 
 def _callback_ip_unassigned(sender, user_token, **kwargs):
-    for vm_res in ActiveVMResource.objects.filter(user_token=user_token, is_started=True):
-        vm_res.network.revoke_access()
+    vm_resources = list(ActiveVMResource.objects.filter(user_token=user_token, is_started=True)
+                        .select_related('network', 'resource'))
+    for vm_res in vm_resources:
+        try:
+            vm_res.network.revoke_access()
+        except (VirtError, libvirt.libvirtError):
+            # The access of the other resources must be revoked anyway
+            pass
+    if getattr(settings, 'VM_SUSPEND_ON_VPN_DISCONNECT', None):
+        for vm_res in vm_resources:
+            if not vm_res.suspended:
+                VMJob.enqueue('suspend', vm_res.resource, user_token)
+
+
+@metrics.register_collector
+def _collect_metrics():
+    is_owned = models.Q(user_token__isnull=False)
+    vm_resources = ActiveVMResource.objects.aggregate(
+        running=models.Count('pk', filter=is_owned & models.Q(is_started=True, suspended='')),
+        suspended=models.Count('pk', filter=models.Q(is_started=True) & ~models.Q(suspended='')),
+        pooled=models.Count('pk', filter=~is_owned & models.Q(is_started=True)),
+        stopped=models.Count('pk', filter=models.Q(is_started=False)),
+        expired=models.Count('pk', filter=is_owned & models.Q(expire_time__lt=now())))
+    vm_counts = dict.fromkeys((state for state, name in VM_STATE_CHOICES), 0)
+    vm_counts.update(VirtualMachine.objects.values_list('state')
+                     .annotate(count=models.Count('pk'))
+                     .order_by())
+    job_counts = dict.fromkeys(('waiting', 'queued', 'running'), 0)
+    job_counts.update(VMJob.objects.filter(state__in=('waiting', 'queued', 'running'))
+                      .values_list('state')
+                      .annotate(count=models.Count('pk'))
+                      .order_by())
+    return [
+        ('insekta_vm_resources', 'Active VM resources',
+         [({'state': state}, vm_resources[state])
+          for state in ('running', 'suspended', 'pooled', 'stopped')]),
+        ('insekta_vm_resources_expired', 'Expired VM resources waiting to be destroyed',
+         [({}, vm_resources['expired'])]),
+        ('insekta_virtual_machines', 'Virtual machines',
+         [({'state': state}, count) for state, count in vm_counts.items()]),
+        ('insekta_vm_jobs', 'Unfinished VM jobs',
+         [({'state': state}, count) for state, count in job_counts.items()]),
+    ]
 
 
+connection_invalidated.connect(_callback_connection_invalidated)
 ip_assigned.connect(_callback_ip_assigned)
 ip_unassigned.connect(_callback_ip_unassigned)
@@ -0,0 +1,54 @@
+import libvirt
+from django.conf import settings
+
+from insektavm.base.virt import connections, CapacityError, VirtError
+
+
+def get_free_memory(node, committed_memory):
+    # All values are in MiB. The free memory reported by the host does not
+    # include VMs that are still booting or have not touched all their memory yet,
+    # so the memory committed to VMs is taken into account as well.
+    virtconn = connections[node]
+    total_memory = virtconn.getInfo()[1]
+    host_free_memory = virtconn.getFreeMemory() // (1024 * 1024)
+    reserved_memory = getattr(settings, 'LIBVIRT_RESERVED_MEMORY', 0)
+    return min(host_free_memory, total_memory - committed_memory) - reserved_memory
+
+
+def get_usable_memory(node):
+    # The most a resource on the node can ever get
+    return connections[node].getInfo()[1] - getattr(settings, 'LIBVIRT_RESERVED_MEMORY', 0)
+
+
+def has_free_memory(node, memory, committed_memory):
+    try:
+        return get_free_memory(node, committed_memory.get(node, 0)) >= memory
+    except (VirtError, libvirt.libvirtError):
+        return False
+
+
+def select_node(memory, committed_memory):
+    # Place the resource on the node with the most free memory. Raises VirtError
+    # instead of CapacityError if waiting for free memory would not help.
+    best_node = None
+    best_free_memory = None
+    fits_any_node = False
+    for node in settings.LIBVIRT_NODES:
+        try:
+            free_memory = get_free_memory(node, committed_memory.get(node, 0))
+            if get_usable_memory(node) >= memory:
+                fits_any_node = True
+        except (VirtError, libvirt.libvirtError):
+            # Might have enough memory once it is back
+            fits_any_node = True
+            continue
+        if free_memory < memory:
+            continue
+        if best_free_memory is None or free_memory > best_free_memory:
+            best_node = node
+            best_free_memory = free_memory
+    if not fits_any_node:
+        raise VirtError('No node has {} MiB of memory for VMs'.format(memory))
+    if best_node is None:
+        raise CapacityError('No node has {} MiB of free memory'.format(memory))
+    return best_node
@@ -1,3 +1,549 @@
-from django.test import TestCase
+from concurrent.futures import Future
+from datetime import timedelta
+import base64
+import errno
+import ipaddress
+import json
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import libvirt
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+
+from insektavm.base import models as base_models
+from insektavm.base.models import UserToken
+from insektavm.base.virt import CapacityError, VirtError
+from insektavm.network.models import NetworkRange
+from insektavm.resources import models as resources_models
+from insektavm.resources.models import Resource
+from insektavm.vm import models as vm_models, scheduler
+from insektavm.vm.models import (ActiveVMResource, NodeLock, VirtualMachine, VMJob,
+                                 VMSnapshot, VMTemplate)
+from insektavm.vpn.models import AssignedIPAddress
+from insektavm.vpn.signals import VPNSender, ip_assigned, ip_unassigned
+
+API_URL = '/api/1.0/vm/'
+
+
+class _ImmediateExecutor:
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+def _create_connections():
+    conns = mock.MagicMock()
+    conns.get_executor.return_value = _ImmediateExecutor()
+    virtconn = conns.__getitem__.return_value
+    pool = virtconn.storagePoolLookupByName.return_value
+    pool.storageVolLookupByName.return_value.path.return_value = '/images/backing.qcow2'
+    pool.storageVolLookupByName.return_value.info.return_value = [0, 1 << 30, 0]
+    pool.createXML.return_value.path.return_value = '/images/vm.qcow2'
+    return conns
+
+
+@override_settings(VM_ASYNC_JOBS=False, VM_STATE_FROM_EVENTS=False)
+class QueryCountTest(TestCase):
+    # Apart from the state update of each VM when it is up, the number of queries
+    # must not depend on the number of VMs of a resource. If one of these tests
+    # fails, check for a query inside a loop first.
+    num_templates = 3
+
+    def setUp(self):
+        resources_models._resource_cache.clear()
+        base_models._user_token_cache.clear()
+        vm_models._storage_pools.clear()
+        vm_models._backing_volumes.clear()
+
+        self.conns = conns = _create_connections()
+        for target in ('insektavm.vm.models.connections',
+                       'insektavm.network.models.connections'):
+            patcher = mock.patch(target, conns)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('insektavm.vm.models.select_node', return_value='default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Created by the first start on a node
+        NodeLock.objects.create(node='default')
+        self.resource = Resource.objects.create(name='lab', type='vmnet')
+        for i in range(self.num_templates):
+            VMTemplate.objects.create(resource=self.resource, name='vm{}'.format(i), memory=512,
+                                      image_fingerprint='0' * 64, image_name='lab_vm.qcow2',
+                                      order_id=i)
+        NetworkRange.objects.create(name='test', network=ipaddress.IPv4Network('10.0.0.0/24'),
+                                    subnet_prefix=28)
+        auth = base64.b64encode(':'.join(settings.API_AUTH).encode()).decode()
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Basic ' + auth
+
+    def _start(self, username='alice'):
+        user_token, created = UserToken.objects.get_or_create(username=username)
+        return ActiveVMResource.start_for(self.resource, user_token)
+
+    def _params(self, username='alice'):
+        return {'resource': 'lab', 'username': username}
+
+    def test_api_start(self):
+        with self.assertNumQueries(30 + self.num_templates):
+            resp = self.client.post(API_URL + 'start', self._params())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.content)['virtual_machines']), self.num_templates)
+
+    def test_api_start_queued(self):
+        with mock.patch('insektavm.vm.models.select_node', side_effect=CapacityError):
+            with self.assertNumQueries(19):
+                resp = self.client.post(API_URL + 'start', self._params())
+            self.assertEqual(json.loads(resp.content)['queue_position'], 1)
+            # Even if there is enough memory for it, a later start waits behind the queue
+            resp = self.client.post(API_URL + 'start', self._params('bob'))
+            self.assertEqual(json.loads(resp.content)['queue_position'], 2)
+            resp = self.client.get(API_URL + 'status', self._params('bob'))
+            self.assertEqual(json.loads(resp.content)['status'], 'queued')
+            resp = self.client.post(API_URL + 'start', self._params('carol'))
+            self.assertEqual(json.loads(resp.content)['queue_position'], 3)
+            resp = self.client.post(API_URL + 'stop', self._params('carol'))
+            self.assertEqual(resp.status_code, 200)
+            # Still no free memory, the queue is left as is
+            ActiveVMResource.destroy_expired()
+        self.assertEqual(VMJob.objects.filter(state='waiting').count(), 2)
+
+        ActiveVMResource.destroy_expired()
+        self.assertFalse(VMJob.objects.filter(state='waiting').exists())
+        self.assertEqual(ActiveVMResource.objects.filter(is_started=True).count(), 2)
+
+    def test_start_creates_node_lock(self):
+        NodeLock.objects.all().delete()
+        self._start()
+        self._start('bob')
+        self.assertEqual(list(NodeLock.objects.values_list('node', flat=True)), ['default'])
+
+    def test_api_stop_admits_waiting(self):
+        self._start()
+        with mock.patch('insektavm.vm.models.select_node', side_effect=CapacityError):
+            resp = self.client.post(API_URL + 'start', self._params('bob'))
+        self.assertEqual(json.loads(resp.content)['status'], 'queued')
+        with mock.patch('insektavm.vm.views._admission_executor', _ImmediateExecutor()):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(API_URL + 'stop', self._params())
+        self.assertFalse(VMJob.objects.filter(state='waiting').exists())
+        self.assertTrue(ActiveVMResource.objects.filter(user_token__username='bob').exists())
+
+    @override_settings(VM_ASYNC_JOBS=True)
+    def test_api_start_queued_async(self):
+        with mock.patch('insektavm.vm.models.select_node', side_effect=CapacityError):
+            resp = self.client.post(API_URL + 'start', self._params())
+            self.assertEqual(json.loads(resp.content)['status'], 'provisioning')
+            VMJob.claim_next().run()
+            resp = self.client.post(API_URL + 'start', self._params())
+        data = json.loads(resp.content)
+        self.assertEqual(data['status'], 'queued')
+        self.assertEqual(data['queue_position'], 1)
+
+    def test_api_start_running(self):
+        self._start()
+        with self.assertNumQueries(4):
+            resp = self.client.post(API_URL + 'start', self._params())
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_stop(self):
+        self._start()
+        with self.assertNumQueries(9):
+            resp = self.client.post(API_URL + 'stop', self._params())
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(VirtualMachine.objects.exists())
+
+    def test_api_ping(self):
+        self._start()
+        with self.assertNumQueries(5):
+            resp = self.client.post(API_URL + 'ping', self._params())
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_ping_cached(self):
+        self._start()
+        self.client.post(API_URL + 'ping', self._params())
+        with self.assertNumQueries(3):
+            self.client.post(API_URL + 'ping', self._params())
+        with override_settings(VM_STATE_FROM_EVENTS=True):
+            with self.assertNumQueries(3):
+                self.client.post(API_URL + 'ping', self._params())
+
+    def test_api_status(self):
+        self._start()
+        AssignedIPAddress.objects.create(user_token=UserToken.objects.get(username='alice'),
+                                         ip_address='10.8.0.2')
+        with self.assertNumQueries(6):
+            resp = self.client.get(API_URL + 'status', self._params())
+        data = json.loads(resp.content)
+        self.assertEqual(data['status'], 'running')
+        self.assertEqual(data['vpn_ip'], '10.8.0.2')
+
+    def test_api_status_suspend_resume(self):
+        vm_res = self._start()
+        for action, status in (('suspend', 'suspending'), ('resume', 'resuming')):
+            job = VMJob.objects.create(resource=self.resource, user_token=vm_res.user_token,
+                                       action=action)
+            resp = self.client.get(API_URL + 'status', self._params())
+            self.assertEqual(json.loads(resp.content)['status'], status)
+            job.state = 'done'
+            job.save()
+
+    def test_api_batch_status(self):
+        usernames = ['user{}'.format(i) for i in range(5)]
+        for username in usernames[:3]:
+            self._start(username)
+        # Only the latest job counts
+        user_token = UserToken.objects.get(username='user0')
+        for action, state in (('start', 'done'), ('stop', 'queued')):
+            VMJob.objects.create(resource=self.resource, user_token=user_token, action=action,
+                                 state=state)
+        operations = [{'action': 'status', 'resource': 'lab', 'username': username}
+                      for username in usernames]
+        with self.assertNumQueries(8):
+            resp = self.client.post(API_URL + 'batch',
+                                    json.dumps({'operations': operations}),
+                                    content_type='application/json')
+        results = json.loads(resp.content)['results']
+        self.assertEqual([result['status'] for result in results],
+                         ['stopping'] + ['running'] * 2 + ['notrunning'] * 2)
+
+    def test_destroy_expired_vms(self):
+        for username in ('alice', 'bob'):
+            vm_res = self._start(username)
+            vm_res.expire_time = now() - timedelta(minutes=1)
+            vm_res.save()
+        with self.assertNumQueries(13), self.assertRaises(SystemExit):
+            call_command('destroy_expired_vms')
+        self.assertFalse(ActiveVMResource.objects.exists())
+
+    def test_fill_vm_pools(self):
+        Resource.objects.filter(pk=self.resource.pk).update(pool_size=1)
+        with self.assertNumQueries(21 + self.num_templates), self.assertRaises(SystemExit):
+            call_command('fill_vm_pools')
+        self.assertTrue(ActiveVMResource.objects.filter(user_token=None).exists())
+
+    def test_fill_vm_pools_with_waiting_start(self):
+        Resource.objects.filter(pk=self.resource.pk).update(pool_size=1)
+        with mock.patch('insektavm.vm.models.select_node', side_effect=CapacityError):
+            self.client.post(API_URL + 'start', self._params())
+        self.assertEqual(ActiveVMResource.fill_pools(), 0)
+        self.assertFalse(ActiveVMResource.objects.exists())
+        VMJob.admit_waiting()
+        self.assertEqual(ActiveVMResource.fill_pools(), 1)
+
+    def test_fill_vm_pools_failed_start(self):
+        Resource.objects.filter(pk=self.resource.pk).update(pool_size=1)
+        dom = self.conns['default'].defineXML.return_value
+        dom.create.side_effect = libvirt.libvirtError('Failed to start')
+        ActiveVMResource.fill_pools()
+        self.assertFalse(ActiveVMResource.objects.exists())
+
+    def test_claim_pooled_with_failed_vm(self):
+        Resource.objects.filter(pk=self.resource.pk).update(pool_size=1)
+        ActiveVMResource.fill_pools()
+        VirtualMachine.objects.filter(pk=VirtualMachine.objects.first().pk).update(state='failed')
+        user_token = UserToken.objects.create(username='alice')
+        self.assertIsNone(ActiveVMResource.claim_pooled(self.resource, user_token))
+
+    def test_vm_job(self):
+        user_token = UserToken.objects.create(username='alice')
+        VMJob.enqueue('start', self.resource, user_token)
+        with self.assertNumQueries(29 + self.num_templates):
+            job = VMJob.claim_next()
+            job.run()
+        self.assertEqual(job.state, 'done')
+
+    def test_start_from_snapshot(self):
+        VMTemplate.objects.update(boot_mode='snapshot')
+        for vm_template in VMTemplate.objects.all():
+            VMSnapshot.objects.create(template=vm_template, node='default', index=0,
+                                      profile_hash=vm_template.get_profile_hash())
+        # Claiming a snapshot takes a few queries per VM. A snapshot is used by
+        # one VM at a time, so the next start boots the VMs.
+        with self.assertNumQueries(28 + 5 * self.num_templates):
+            vm_res = self._start('alice')
+        self.assertEqual(vm_res.virtualmachine_set.filter(snapshot__isnull=False).count(),
+                         self.num_templates)
+        virtconn = self.conns['default']
+        self.assertEqual(virtconn.restoreFlags.call_count, self.num_templates)
+        vm_res = self._start('bob')
+        self.assertFalse(vm_res.virtualmachine_set.filter(snapshot__isnull=False).exists())
+        self.assertEqual(virtconn.restoreFlags.call_count, self.num_templates)
+
+        ActiveVMResource.objects.get(user_token__username='alice').destroy()
+        self.assertFalse(VirtualMachine.objects.filter(snapshot__isnull=False).exists())
+        self.assertEqual(VMSnapshot.objects.count(), self.num_templates)
+
+    def test_start_from_snapshot_failed_restore(self):
+        VMTemplate.objects.update(boot_mode='snapshot')
+        for vm_template in VMTemplate.objects.all():
+            VMSnapshot.objects.create(template=vm_template, node='default', index=0,
+                                      profile_hash=vm_template.get_profile_hash())
+        virtconn = self.conns['default']
+        virtconn.restoreFlags.side_effect = libvirt.libvirtError('Failed to restore')
+        executor = self.conns.get_executor.return_value
+
+        def submit(func, *args):
+            # The executor threads must not query the database
+            with self.assertNumQueries(0):
+                return _ImmediateExecutor().submit(func, *args)
+
+        with mock.patch.object(executor, 'submit', submit):
+            vm_res = self._start()
+        self.assertEqual(virtconn.defineXML.return_value.create.call_count, self.num_templates)
+        self.assertEqual(list(vm_res.virtualmachine_set.values_list('state', flat=True)),
+                         ['running'] * self.num_templates)
+        self.assertFalse(VirtualMachine.objects.filter(snapshot__isnull=False).exists())
+
+    @override_settings(LIBVIRT_NODES={'default': 'test:///default'}, VM_SNAPSHOT_COPIES=1)
+    def test_outdated_snapshot(self):
+        VMTemplate.objects.update(boot_mode='snapshot')
+        for vm_template in VMTemplate.objects.all():
+            VMSnapshot.objects.create(template=vm_template, node='default', index=0,
+                                      profile_hash=vm_template.get_profile_hash())
+        VMTemplate.objects.update(vcpus=2)
+        vm_res = self._start()
+        self.assertFalse(vm_res.virtualmachine_set.filter(snapshot__isnull=False).exists())
+        self.assertFalse(self.conns['default'].restoreFlags.called)
+
+        with mock.patch.object(VMSnapshot, 'delete_volumes') as delete_volumes, \
+                mock.patch.object(VMSnapshot, 'capture') as capture, \
+                self.assertRaises(SystemExit):
+            call_command('capture_vm_snapshots', stdout=mock.Mock())
+        self.assertEqual(delete_volumes.call_count, self.num_templates)
+        self.assertEqual(capture.call_count, self.num_templates)
+
+    @override_settings(VM_SUSPEND_ON_VPN_DISCONNECT='managedsave')
+    def test_suspend_on_vpn_disconnect(self):
+        vm_res = self._start()
+        user_token = vm_res.user_token
+        ip_assigned.send(VPNSender, user_token=user_token, ip_address='10.8.0.2')
+        ip_unassigned.send(VPNSender, user_token=user_token)
+        # The VPN does not wait for the VMs to be saved
+        vm_res.refresh_from_db()
+        self.assertEqual(vm_res.suspended, '')
+        VMJob.claim_next().run()
+        vm_res.refresh_from_db()
+        self.assertEqual(vm_res.suspended, 'managedsave')
+        self.assertEqual(VirtualMachine.get_committed_memory(), {})
+        virtconn = self.conns['default']
+        self.assertEqual(virtconn.lookupByName.return_value.managedSave.call_count,
+                         self.num_templates)
+        # Suspended resources are healthy
+        resp = self.client.post(API_URL + 'ping', self._params())
+        self.assertEqual(resp.status_code, 200)
+
+        ip_assigned.send(VPNSender, user_token=user_token, ip_address='10.8.0.2')
+        with mock.patch('insektavm.vm.models.has_free_memory', return_value=True):
+            VMJob.claim_next().run()
+        vm_res.refresh_from_db()
+        self.assertEqual(vm_res.suspended, '')
+        self.assertEqual(set(vm_res.virtualmachine_set.values_list('state', flat=True)),
+                         {'running'})
+
+    @override_settings(VM_SUSPEND_ON_VPN_DISCONNECT='managedsave')
+    def test_suspend_admits_waiting(self):
+        vm_res = self._start()
+        with mock.patch('insektavm.vm.models.select_node', side_effect=CapacityError):
+            self.client.post(API_URL + 'start', self._params('bob'))
+        self.assertTrue(VMJob.objects.filter(state='waiting').exists())
+        ip_unassigned.send(VPNSender, user_token=vm_res.user_token)
+        VMJob.claim_next().run()
+        self.assertFalse(VMJob.objects.filter(state='waiting').exists())
+        self.assertTrue(ActiveVMResource.objects.filter(user_token__username='bob').exists())
+
+    @override_settings(VM_SUSPEND_ON_VPN_DISCONNECT='managedsave')
+    def test_reconnect_before_suspend(self):
+        vm_res = self._start()
+        user_token = vm_res.user_token
+        ip_unassigned.send(VPNSender, user_token=user_token)
+        ip_assigned.send(VPNSender, user_token=user_token, ip_address='10.8.0.2')
+        self.assertIsNone(VMJob.claim_next())
+        vm_res.refresh_from_db()
+        self.assertEqual(vm_res.suspended, '')
+
+    @override_settings(VM_SUSPEND_ON_VPN_DISCONNECT='managedsave')
+    def test_revoke_access_failed(self):
+        for username in ('alice', 'bob'):
+            self._start(username)
+        user_token = UserToken.objects.get(username='alice')
+        other_resource = Resource.objects.create(name='lab2', type='vmnet')
+        VMTemplate.objects.create(resource=other_resource, name='vm', memory=512,
+                                  image_fingerprint='0' * 64, image_name='lab_vm.qcow2',
+                                  order_id=0)
+        ActiveVMResource.start_for(other_resource, user_token)
+        virtconn = self.conns['default']
+        virtconn.nwfilterDefineXML.side_effect = libvirt.libvirtError('Failed')
+        ip_unassigned.send(VPNSender, user_token=user_token)
+        self.assertEqual(virtconn.nwfilterDefineXML.call_count, 2)
+        self.assertEqual(VMJob.objects.filter(action='suspend').count(), 2)
+
+    @override_settings(VM_ASYNC_JOBS=True)
+    def test_api_start_suspended_async(self):
+        vm_res = self._start()
+        ActiveVMResource.objects.filter(pk=vm_res.pk).update(suspended='managedsave')
+        resp = self.client.post(API_URL + 'start', self._params())
+        self.assertEqual(json.loads(resp.content)['status'], 'provisioning')
+        with mock.patch('insektavm.vm.models.has_free_memory', return_value=True):
+            VMJob.claim_next().run()
+        vm_res.refresh_from_db()
+        self.assertEqual(vm_res.suspended, '')
+
+    def test_requeue_stale_jobs(self):
+        user_token = UserToken.objects.create(username='alice')
+        VMJob.enqueue('start', self.resource, user_token)
+        job = VMJob.claim_next()
+        self.assertEqual(VMJob.requeue_stale(), 0)
+        VMJob.objects.filter(pk=job.pk).update(heartbeat_time=now() - timedelta(hours=1))
+        self.assertEqual(VMJob.requeue_stale(), 1)
+        self.assertEqual(VMJob.claim_next().pk, job.pk)
+
+    def test_prune_jobs(self):
+        user_token = UserToken.objects.create(username='alice')
+        for days in (1, 30):
+            VMJob.objects.create(resource=self.resource, user_token=user_token, action='stop',
+                                 state='done', finished_time=now() - timedelta(days=days))
+        self.assertEqual(VMJob.prune(), 1)
+        self.assertEqual(VMJob.objects.count(), 1)
+
+    def test_sync_states(self):
+        vm_res = self._start()
+        vm_pks = list(vm_res.virtualmachine_set.values_list('pk', flat=True))
+        # One update for every state that changes
+        with self.assertNumQueries(3):
+            VirtualMachine.sync_states('default', {vm_pks[0]: 'crashed', vm_pks[1]: 'running'})
+        self.assertEqual(VirtualMachine.objects.filter(state='stopped').count(),
+                         self.num_templates - 2)
+
+
+@override_settings(LIBVIRT_NODES={'small': 'test:///default', 'large': 'test:///default'},
+                   LIBVIRT_RESERVED_MEMORY=0)
+class SchedulerTest(SimpleTestCase):
+    def setUp(self):
+        conns = mock.MagicMock()
+        # Total memory in MiB, free memory in bytes
+        memory = {'small': (1024, 512), 'large': (4096, 1024)}
+        conns.__getitem__.side_effect = lambda node: mock.Mock(**{
+            'getInfo.return_value': ['x86_64', memory[node][0]],
+            'getFreeMemory.return_value': memory[node][1] * 1024 * 1024})
+        patcher = mock.patch('insektavm.vm.scheduler.connections', conns)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_select_node(self):
+        self.assertEqual(scheduler.select_node(512, {}), 'large')
+        self.assertEqual(scheduler.select_node(512, {'large': 3584}), 'small')
+
+    def test_select_node_busy(self):
+        with self.assertRaises(CapacityError):
+            scheduler.select_node(2048, {})
+
+    def test_select_node_too_large(self):
+        with self.assertRaises(VirtError) as cm:
+            scheduler.select_node(8192, {})
+        self.assertNotIsInstance(cm.exception, CapacityError)
+
+
+@override_settings(LIBVIRT_NODES={'default': 'test:///default'})
+class ImportImageTest(TestCase):
+    def setUp(self):
+        self.conns = mock.MagicMock()
+        patcher = mock.patch('insektavm.vm.models.connections', self.conns)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        virtconn = self.conns['default']
+        virtconn.newStream.return_value.send.side_effect = len
+        self.pool = virtconn.storagePoolLookupByName.return_value
+        self.pool.createXML.return_value.infoFlags.return_value = [0, 0, 4096]
+        self.resource = Resource.objects.create(name='lab', type='vmnet')
+        f = tempfile.NamedTemporaryFile()
+        self.addCleanup(f.close)
+        f.write(b'x' * 4096)
+        f.flush()
+        self.image_filename = f.name
+
+    def _import(self, name):
+        return VMTemplate.from_image(self.resource, name, memory=512, boot_type='mbr',
+                                     order_id=0, image_filename=self.image_filename)
+
+    def test_reuse_identical_image(self):
+        first = self._import('vm1')
+        self.assertFalse(self.pool.createXML.return_value.delete.called)
+        second = self._import('vm2')
+        self.assertEqual(second.image_name, first.image_name)
+        self.assertEqual(second.image_fingerprint, first.image_fingerprint)
+        self.assertEqual(self.pool.createXML.return_value.delete.call_count, 1)
+
+        # The volume is only deleted with the last template using it
+        second.delete_image()
+        second.delete()
+        self.assertFalse(self.pool.storageVolLookupByName.called)
+        first.delete_image()
+        self.pool.storageVolLookupByName.assert_called_once_with(first.image_name)
+
+
+class VMTemplateTest(SimpleTestCase):
+    def test_native_io_requires_no_cache(self):
+        vm_template = VMTemplate(disk_io='native', disk_cache='writeback')
+        with self.assertRaises(ValidationError):
+            vm_template.clean()
+        vm_template.disk_cache = 'none'
+        vm_template.clean()
+
+    def test_profile_hash(self):
+        vm_template = VMTemplate(memory=512, image_name='lab_vm.qcow2')
+        profile_hash = vm_template.get_profile_hash()
+        self.assertEqual(VMTemplate(memory=512, image_name='lab_vm.qcow2').get_profile_hash(),
+                         profile_hash)
+        vm_template.disk_cache = 'none'
+        self.assertNotEqual(vm_template.get_profile_hash(), profile_hash)
+
+
+class ImageSegmentsTest(SimpleTestCase):
+    def _segments(self, f, file_size):
+        segments = list(vm_models._iter_image_segments(f, file_size))
+        # The segments cover the whole file without gaps
+        offset = 0
+        for is_data, segment_offset, length in segments:
+            self.assertEqual(segment_offset, offset)
+            self.assertGreater(length, 0)
+            offset += length
+        self.assertEqual(offset, file_size)
+        return segments
+
+    def test_sparse_file(self):
+        file_size = 16 * 1024 * 1024
+        with tempfile.TemporaryFile() as f:
+            f.seek(4 * 1024 * 1024)
+            f.write(b'x' * 4096)
+            f.truncate(file_size)
+            f.flush()
+            segments = self._segments(f, file_size)
+            # Holes may only be skipped if they read as zeros
+            for is_data, offset, length in segments:
+                if not is_data:
+                    f.seek(offset)
+                    self.assertEqual(f.read(length).count(0), length)
+            data_segments = [(offset, length) for is_data, offset, length in segments if is_data]
+            self.assertTrue(any(offset <= 4 * 1024 * 1024 < offset + length
+                                for offset, length in data_segments))
+
+    def test_only_hole(self):
+        with tempfile.TemporaryFile() as f:
+            f.truncate(1024 * 1024)
+            segments = self._segments(f, 1024 * 1024)
+        # File systems without hole detection report the hole as data
+        self.assertIn(segments, ([(False, 0, 1024 * 1024)], [(True, 0, 1024 * 1024)]))
+
+    def test_no_hole_detection(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'x' * 4096)
+            f.flush()
+            with mock.patch('os.lseek', side_effect=OSError(errno.EINVAL, 'Not supported')):
+                segments = self._segments(f, 4096)
+        self.assertEqual(segments, [(True, 0, 4096)])
@@ -1,44 +1,238 @@
+from concurrent.futures import ThreadPoolExecutor
 import calendar
+import contextvars
+import json
 
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
 from django.http import HttpResponseBadRequest, HttpResponseNotFound
 from django.views.decorators.http import require_POST, require_GET
 
 from insektavm.base.models import UserToken
 from insektavm.base.restapi import ApiError, rest_api
+from insektavm.base.virt import CapacityError, VirtError
 from insektavm.resources.models import Resource
-from insektavm.vm.models import ActiveVMResource
+from insektavm.vm.models import ActiveVMResource, VMJob
 from insektavm.vpn.models import AssignedIPAddress
 
+BATCH_ACTIONS = ('start', 'stop', 'ping', 'status')
+
+# Status of a resource while a job of the action is pending
+JOB_STATUSES = {
+    'start': 'provisioning',
+    'stop': 'stopping',
+    'suspend': 'suspending',
+    'resume': 'resuming',
+}
+
+# Shared by all batch requests. Its threads live as long as the process, so their
+# libvirt and database connections are reused instead of opened for every batch.
+_batch_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'API_BATCH_WORKERS', 8),
+                                     thread_name_prefix='api-batch')
+# Admits waiting starts after a stop, so the stop request does not wait for them
+_admission_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='api-admission')
+
 
 @require_POST
 @rest_api
 def api_start_vm(request):
     resource, user_token = _api_get_parameters(request.POST)
-    vm_res = ActiveVMResource.start_for(resource, user_token)
-    return _vm_res_json(vm_res)
+    return _start_vm(resource, user_token)
 
 
 @require_POST
 @rest_api
 def api_stop_vm(request):
     resource, user_token = _api_get_parameters(request.POST)
+    vm_res = (ActiveVMResource.objects.filter(resource=resource, user_token=user_token)
+              .select_related('network')
+              .first())
+    return _stop_vm(resource, user_token, vm_res)
+
+
+@require_POST
+@rest_api
+def api_ping_vm(request):
+    resource, user_token = _api_get_parameters(request.POST)
+    vm_res = (ActiveVMResource.objects.filter(resource=resource, user_token=user_token)
+              .select_related('network')
+              .first())
+    return _ping_vm(vm_res)
+
+
+@require_GET
+@rest_api
+def api_get_vm_status(request):
+    resource, user_token = _api_get_parameters(request.GET)
+    vm_res = (ActiveVMResource.objects.filter(resource=resource, user_token=user_token)
+              .select_related('network')
+              .first())
+    job = VMJob.objects.filter(resource=resource, user_token=user_token).order_by('-pk').first()
     try:
-        vm_res = ActiveVMResource.objects.get(resource=resource, user_token=user_token)
-    except ActiveVMResource.DoesNotExist:
+        vpn_ip = AssignedIPAddress.objects.get(user_token=user_token).ip_address
+    except AssignedIPAddress.DoesNotExist:
+        vpn_ip = None
+    return _get_vm_status(vm_res, job, vpn_ip)
+
+
+@require_POST
+@rest_api
+def api_batch(request):
+    # Expects a JSON body like {"operations": [{"action": "status", "resource": "...",
+    # "username": "..."}, ...]} and returns a result for each operation in the same order
+    try:
+        operations = json.loads(request.body)['operations']
+        if not isinstance(operations, list):
+            raise ValueError
+        for operation in operations:
+            if (operation.get('action') not in BATCH_ACTIONS or
+                    not isinstance(operation.get('resource'), str) or
+                    not isinstance(operation.get('username'), str)):
+                raise ValueError
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ApiError('Require a JSON body with a list of operations, each having '
+                       'an action, resource and username.', HttpResponseBadRequest)
+    max_operations = getattr(settings, 'API_BATCH_MAX_OPERATIONS', 500)
+    if len(operations) > max_operations:
+        raise ApiError('At most {} operations are allowed.'.format(max_operations),
+                       HttpResponseBadRequest)
+
+    # Look everything up with a few IN queries instead of a few queries per operation
+    resources = {resource.name: resource for resource in
+                 Resource.objects.filter(name__in={op['resource'] for op in operations},
+                                         type='vmnet')}
+    user_tokens = _get_user_tokens({op['username'] for op in operations})
+    vm_resources = {}
+    for vm_res in (ActiveVMResource.objects
+                   .filter(resource__in=resources.values(), user_token__in=user_tokens.values())
+                   .select_related('network')
+                   .prefetch_related(ActiveVMResource.get_vms_prefetch())):
+        vm_resources[vm_res.resource_id, vm_res.user_token_id] = vm_res
+    # Only the latest job of each resource and user matters
+    latest_job_pks = (VMJob.objects
+                      .filter(resource__in=resources.values(), user_token__in=user_tokens.values())
+                      .values('resource', 'user_token')
+                      .annotate(latest_pk=models.Max('pk'))
+                      .values('latest_pk'))
+    jobs = {(job.resource_id, job.user_token_id): job
+            for job in VMJob.objects.filter(pk__in=latest_job_pks)}
+    vpn_ips = dict(AssignedIPAddress.objects.filter(user_token__in=user_tokens.values())
+                   .values_list('user_token_id', 'ip_address'))
+
+    def run(operation):
+        try:
+            try:
+                resource = resources[operation['resource']]
+            except KeyError:
+                raise ApiError('No such resource: {}'.format(operation['resource']),
+                               HttpResponseNotFound)
+            user_token = user_tokens[operation['username']]
+            key = (resource.pk, user_token.pk)
+            vm_res = vm_resources.get(key)
+            if operation['action'] == 'start':
+                return _start_vm(resource, user_token)
+            elif operation['action'] == 'stop':
+                return _stop_vm(resource, user_token, vm_res)
+            elif operation['action'] == 'ping':
+                return _ping_vm(vm_res)
+            else:
+                return _get_vm_status(vm_res, jobs.get(key), vpn_ips.get(user_token.pk))
+        except ApiError as e:
+            return {'error': e.message, 'status': e.resp_class.status_code}
+        except VirtError as e:
+            return {'error': str(e), 'status': 503}
+        finally:
+            # Like at the end of a request
+            close_old_connections()
+
+    # Starting, stopping and pinging wait for libvirt, so the operations run concurrently.
+    # The context carries the trace of the request over to the executor threads.
+    futures = [_batch_executor.submit(contextvars.copy_context().run, run, operation)
+               for operation in operations]
+    results = [future.result() for future in futures]
+    return {
+        'results': results
+    }
+
+
+def _start_vm(resource, user_token):
+    if not getattr(settings, 'VM_ASYNC_JOBS', False):
+        try:
+            vm_res = ActiveVMResource.start_for(resource, user_token)
+        except CapacityError:
+            # Started once a stop or destroy_expired_vms frees enough memory
+            job = VMJob.enqueue('start', resource, user_token, state='waiting')
+            return _queued_json(job)
+        return _vm_res_json(vm_res)
+
+    job = VMJob.get_pending(resource, user_token)
+    if job is None:
+        # Already running or a pre-started instance is available, no need to wait
+        vm_res = (ActiveVMResource.objects.filter(resource=resource, user_token=user_token,
+                                                  is_started=True)
+                  .select_related('network')
+                  .first())
+        if vm_res is None:
+            vm_res = ActiveVMResource.claim_pooled(resource, user_token)
+        # Resuming a suspended resource takes a while, the start job does it
+        if vm_res is not None and not vm_res.suspended:
+            return dict(_vm_res_json(vm_res), status='running')
+    elif job.state == 'waiting' and job.action == 'start':
+        return _queued_json(job)
+    job = VMJob.enqueue('start', resource, user_token)
+    return {
+        'status': 'provisioning',
+        'job_id': job.pk
+    }
+
+
+def _queued_json(job):
+    return {
+        'status': 'queued',
+        'job_id': job.pk,
+        'queue_position': job.get_queue_position()
+    }
+
+
+def _stop_vm(resource, user_token, vm_res):
+    # Starts waiting for capacity are just dropped from the queue
+    if VMJob.cancel_waiting(resource, user_token):
+        _admit_waiting_on_commit()
+        if vm_res is None:
+            return {
+                'result': 'ok'
+            }
+    if getattr(settings, 'VM_ASYNC_JOBS', False):
+        if vm_res is None and VMJob.get_pending(resource, user_token) is None:
+            raise ApiError('No such network is running', HttpResponseNotFound)
+        job = VMJob.enqueue('stop', resource, user_token)
+        return {
+            'result': 'ok',
+            'status': 'stopping',
+            'job_id': job.pk
+        }
+    if vm_res is None:
         raise ApiError('No such network is running', HttpResponseNotFound)
     vm_res.destroy()
+    _admit_waiting_on_commit()
     return {
         'result': 'ok'
     }
 
 
-@require_POST
-@rest_api
-def api_ping_vm(request):
-    resource, user_token = _api_get_parameters(request.POST)
+def _admit_waiting_on_commit():
+    transaction.on_commit(lambda: _admission_executor.submit(_admit_waiting))
+
+
+def _admit_waiting():
     try:
-        vm_res = ActiveVMResource.objects.get(resource=resource, user_token=user_token)
-    except ActiveVMResource.DoesNotExist:
+        VMJob.admit_waiting()
+    finally:
+        close_old_connections()
+
+
+def _ping_vm(vm_res):
+    if vm_res is None:
         raise ApiError('No such network is running', HttpResponseNotFound)
     expire_time = vm_res.ping()
     return {
@@ -47,26 +241,23 @@ def api_ping_vm(request):
     }
 
 
-@require_GET
-@rest_api
-def api_get_vm_status(request):
-    resource, user_token = _api_get_parameters(request.GET)
-    try:
-        vm_res = ActiveVMResource.objects.get(resource=resource, user_token=user_token)
+def _get_vm_status(vm_res, job, vpn_ip):
+    if vm_res is not None:
         status = 'running'
-        resource = _vm_res_json(vm_res)
-    except ActiveVMResource.DoesNotExist:
+        resource_json = _vm_res_json(vm_res)
+    else:
         status = 'notrunning'
-        resource = None
+        resource_json = None
 
-    try:
-        vpn_ip = AssignedIPAddress.objects.get(user_token=user_token).ip_address
-    except AssignedIPAddress.DoesNotExist:
-        vpn_ip = None
+    if job is not None and job.state == 'waiting':
+        status = 'queued'
+    elif job is not None and job.state in ('queued', 'running'):
+        status = JOB_STATUSES[job.action]
 
     return {
         'status': status,
-        'resource': resource,
+        'resource': resource_json,
+        'job': _job_json(job) if job is not None else None,
         'vpn_ip': vpn_ip
     }
 
@@ -82,22 +273,46 @@ def _api_get_parameters(params):
         raise ApiError('Require username parameter.', HttpResponseBadRequest)
 
     try:
-        resource = Resource.objects.get(name=resource_str, type='vmnet')
+        resource = Resource.get_cached(resource_str, 'vmnet')
     except Resource.DoesNotExist:
         raise ApiError('No such resource: {}'.format(resource_str), HttpResponseNotFound)
 
-    user_token, created = UserToken.objects.get_or_create(username=username)
+    user_token = UserToken.get_or_create_cached(username)
 
     return resource, user_token
 
 
+def _get_user_tokens(usernames):
+    user_tokens = {user_token.username: user_token for user_token in
+                   UserToken.objects.filter(username__in=usernames)}
+    missing_usernames = usernames - user_tokens.keys()
+    if missing_usernames:
+        UserToken.objects.bulk_create([UserToken(username=username)
+                                       for username in missing_usernames],
+                                      ignore_conflicts=True)
+        for user_token in UserToken.objects.filter(username__in=missing_usernames):
+            user_tokens[user_token.username] = user_token
+    return user_tokens
+
+
 def _vm_res_json(vm_res):
     return {
         'id': vm_res.pk,
         'expire_time': _to_timestamp(vm_res.expire_time),
+        'suspended': bool(vm_res.suspended),
         'virtual_machines': vm_res.get_vms()
     }
 
 
+def _job_json(job):
+    return {
+        'id': job.pk,
+        'action': job.action,
+        'state': job.state,
+        'error': job.error,
+        'queue_position': job.get_queue_position() if job.state == 'waiting' else None
+    }
+
+
 def _to_timestamp(expire_time):
     return calendar.timegm(expire_time.utctimetuple())
@@ -1,3 +1,108 @@
-from django.test import TestCase
+from concurrent.futures import Future
+import base64
+import ipaddress
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from insektavm.base import models as base_models
+from insektavm.base.models import UserToken
+from insektavm.network.models import NetworkRange
+from insektavm.resources import models as resources_models
+from insektavm.resources.models import Resource
+from insektavm.vm import models as vm_models
+from insektavm.vm.models import ActiveVMResource, NodeLock, VMJob, VMTemplate
+from insektavm.vpn.models import AssignedIPAddress
+
+API_URL = '/api/1.0/vpn/'
+
+
+class _ImmediateExecutor:
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+@override_settings(VM_ASYNC_JOBS=False, VM_SUSPEND_ON_VPN_DISCONNECT='managedsave')
+class QueryCountTest(TestCase):
+    # The VPN waits for these requests. Each started resource of the user adds the
+    # queries for its filter and its suspend or resume job, but none per VM.
+    def setUp(self):
+        resources_models._resource_cache.clear()
+        base_models._user_token_cache.clear()
+        vm_models._storage_pools.clear()
+        vm_models._backing_volumes.clear()
+
+        conns = mock.MagicMock()
+        conns.get_executor.return_value = _ImmediateExecutor()
+        pool = conns.__getitem__.return_value.storagePoolLookupByName.return_value
+        pool.storageVolLookupByName.return_value.info.return_value = [0, 1 << 30, 0]
+        for target in ('insektavm.vm.models.connections',
+                       'insektavm.network.models.connections'):
+            patcher = mock.patch(target, conns)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('insektavm.vm.models.select_node', return_value='default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        NodeLock.objects.create(node='default')
+        NetworkRange.objects.create(name='test', network=ipaddress.IPv4Network('10.0.0.0/24'),
+                                    subnet_prefix=28)
+        self.resources = []
+        for i in range(2):
+            resource = Resource.objects.create(name='lab{}'.format(i), type='vmnet')
+            for j in range(2):
+                VMTemplate.objects.create(resource=resource, name='vm{}'.format(j), memory=512,
+                                          image_fingerprint='0' * 64,
+                                          image_name='lab_vm.qcow2', order_id=j)
+            self.resources.append(resource)
+        self.user_token = UserToken.objects.create(username='alice')
+        auth = base64.b64encode(':'.join(settings.API_AUTH).encode()).decode()
+        self.client.defaults['HTTP_AUTHORIZATION'] = 'Basic ' + auth
+
+    def _start_all(self):
+        for resource in self.resources:
+            ActiveVMResource.start_for(resource, self.user_token)
+
+    def _assign(self):
+        return self.client.post(API_URL + 'assign',
+                                {'username': 'alice', 'ip_address': '10.8.0.2'})
+
+    def test_assign(self):
+        with self.assertNumQueries(10):
+            resp = self._assign()
+        self.assertEqual(resp.status_code, 200)
+
+    def test_assign_with_resources(self):
+        self._start_all()
+        with self.assertNumQueries(12):
+            resp = self._assign()
+        self.assertEqual(resp.status_code, 200)
+
+    def test_unassign(self):
+        self._assign()
+        with self.assertNumQueries(3):
+            resp = self.client.post(API_URL + 'unassign', {'username': 'alice'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(AssignedIPAddress.objects.exists())
+
+    def test_unassign_with_resources(self):
+        self._start_all()
+        self._assign()
+        with self.assertNumQueries(9):
+            resp = self.client.post(API_URL + 'unassign', {'username': 'alice'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(VMJob.objects.filter(action='suspend').count(), 2)
+
+    def test_reassign_with_suspended_resources(self):
+        self._start_all()
+        self._assign()
+        ActiveVMResource.objects.update(suspended='managedsave')
+        self.client.post(API_URL + 'unassign', {'username': 'alice'})
+        with self.assertNumQueries(15):
+            resp = self._assign()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(VMJob.objects.filter(action='resume').count(), 2)
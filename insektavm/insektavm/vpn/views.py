@@ -29,7 +29,7 @@ def api_assign_ip(request):
         raise ApiError('Parameter ip_address is not a valid IPv4 address.',
                        HttpResponseBadRequest)
 
-    user_token, created = UserToken.objects.get_or_create(username=username)
+    user_token = UserToken.get_or_create_cached(username)
 
     # Try to unassign the IP address first if it belongs to another user,
     # in case we lost some notification